@@ -26,6 +26,11 @@ OTHER_FILES = [
 ]
 
 defs_stepcompress = """
+    struct stepcompress_stats {
+        uint64_t step_count, queue_step_count;
+        double compress_time;
+    };
+
     struct stepcompress *stepcompress_alloc(uint32_t oid);
     void stepcompress_fill(struct stepcompress *sc, uint32_t max_error
         , uint32_t invert_sdir, uint32_t queue_step_msgid
@@ -34,6 +39,8 @@ defs_stepcompress = """
     int stepcompress_reset(struct stepcompress *sc, uint64_t last_step_clock);
     int stepcompress_queue_msg(struct stepcompress *sc
         , uint32_t *data, int len);
+    void stepcompress_get_stats(struct stepcompress *sc
+        , struct stepcompress_stats *stats);
 
     struct steppersync *steppersync_alloc(struct serialqueue *sq
         , struct stepcompress **sc_list, int sc_num, int move_num);
@@ -57,14 +64,20 @@ defs_itersolve = """
     void itersolve_set_position(struct stepper_kinematics *sk
         , double x, double y, double z);
     double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
+    void itersolve_set_linear(struct stepper_kinematics *sk
+        , double x, double y, double z);
 """
 
+# Number of doubles in each trapq_append_batch() move record
+TRAPQ_APPEND_SIZE = 13
+
 defs_trapq = """
     void trapq_append(struct trapq *tq, double print_time
         , double accel_t, double cruise_t, double decel_t
         , double start_pos_x, double start_pos_y, double start_pos_z
         , double axes_r_x, double axes_r_y, double axes_r_z
         , double start_v, double cruise_v, double accel);
+    void trapq_append_batch(struct trapq *tq, double *moves, int count);
     struct trapq *trapq_alloc(void);
     void trapq_free(struct trapq *tq);
     void trapq_free_moves(struct trapq *tq, double print_time);
@@ -119,8 +132,13 @@ defs_serialqueue = """
     void serialqueue_free_commandqueue(struct command_queue *cq);
     void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
         , uint8_t *msg, int len, uint64_t min_clock, uint64_t req_clock);
+    void serialqueue_send_multiple(struct serialqueue *sq
+        , struct command_queue *cq, uint8_t *msgs, int *lens, int count
+        , uint64_t min_clock, uint64_t req_clock);
     void serialqueue_pull(struct serialqueue *sq
         , struct pull_queue_message *pqm);
+    int serialqueue_pull_multiple(struct serialqueue *sq
+        , struct pull_queue_message *q, int max);
     void serialqueue_set_baud_adjust(struct serialqueue *sq
         , double baud_adjust);
     void serialqueue_set_receive_window(struct serialqueue *sq
@@ -4,7 +4,7 @@
 //
 // This file may be distributed under the terms of the GNU GPLv3 license.
 
-#include <math.h> // fabs
+#include <math.h> // fabs, sqrt
 #include <stddef.h> // offsetof
 #include <string.h> // memset
 #include "compiler.h" // __visible
@@ -130,6 +130,78 @@ itersolve_gen_steps_range(struct stepper_kinematics *sk, struct move *m
     return 0;
 }
 
+// Generate step times for a portion of a move using a closed-form
+// solution (the stepper position must be a linear function of the
+// cartesian coordinates of the move - see itersolve_set_linear() )
+static int32_t
+itersolve_gen_steps_linear(struct stepper_kinematics *sk, struct move *m
+                           , double move_start, double move_end)
+{
+    struct stepcompress *sc = sk->sc;
+    double half_step = .5 * sk->step_dist;
+    double mcu_freq = stepcompress_get_mcu_freq(sc);
+    double start = move_start - m->print_time, end = move_end - m->print_time;
+    // Stepper position is base + ratio * move_get_distance(m, move_time)
+    struct coord *c = &sk->linear_coef;
+    double base = (c->x * m->start_pos.x + c->y * m->start_pos.y
+                   + c->z * m->start_pos.z);
+    double ratio = c->x * m->axes_r.x + c->y * m->axes_r.y + c->z * m->axes_r.z;
+    double end_pos = base + ratio * move_get_distance(m, end);
+    // Arrange for the distance along the move to be non-decreasing
+    double start_v = m->start_v, half_accel = m->half_accel;
+    if (start_v < 0. || (!start_v && half_accel < 0.)) {
+        start_v = -start_v;
+        half_accel = -half_accel;
+        ratio = -ratio;
+    }
+    double last_time = start, last_position = sk->commanded_pos;
+    int sdir = stepcompress_get_step_dir(sc);
+    struct queue_append qa = queue_append_start(sc, m->print_time, .5);
+    for (;;) {
+        // Determine if next step is in forward or reverse direction
+        double dist = end_pos - last_position;
+        if (fabs(dist) < half_step)
+            // At end of move
+            break;
+        int next_sdir = dist > 0.;
+        if (unlikely(next_sdir != sdir)) {
+            // Direction change
+            if (fabs(dist) < half_step + .000000001)
+                // Only change direction if going past midway point
+                break;
+            int ret = queue_append_set_next_step_dir(&qa, next_sdir);
+            if (ret)
+                return ret;
+            sdir = next_sdir;
+        }
+        // Solve start_v*t + half_accel*t^2 == move_dist for time t
+        double target = last_position + (sdir ? half_step : -half_step);
+        double step_time = last_time;
+        if (ratio) {
+            double move_dist = (target - base) / ratio;
+            double disc = start_v*start_v + 4. * half_accel * move_dist;
+            double denom = start_v + (disc > 0. ? sqrt(disc) : 0.);
+            if (denom > 0.)
+                step_time = 2. * move_dist / denom;
+            if (step_time < last_time)
+                step_time = last_time;
+            else if (step_time > end)
+                step_time = end;
+        }
+        // Add step at given time
+        int ret = queue_append(&qa, step_time * mcu_freq);
+        if (ret)
+            return ret;
+        last_position = target + (sdir ? half_step : -half_step);
+        last_time = step_time;
+    }
+    queue_append_finish(qa);
+    sk->commanded_pos = last_position;
+    if (sk->post_cb)
+        sk->post_cb(sk);
+    return 0;
+}
+
 // Check if a move is likely to cause movement on a stepper
 static inline int
 check_active(struct stepper_kinematics *sk, struct move *m)
@@ -148,7 +220,6 @@ itersolve_generate_steps(struct stepper_kinematics *sk, double flush_time)
     sk->last_flush_time = flush_time;
     if (!sk->tq)
         return 0;
-    trapq_check_sentinels(sk->tq);
     struct move *m = list_first_entry(&sk->tq->moves, struct move, node);
     while (last_flush_time >= m->print_time + m->move_t)
         m = list_next_entry(m, node);
@@ -173,7 +244,9 @@ itersolve_generate_steps(struct stepper_kinematics *sk, double flush_time)
                 continue;
             }
             // Generate steps for this move
-            int32_t ret = itersolve_gen_steps_range(sk, m, start, end);
+            int32_t ret = (sk->is_linear
+                           ? itersolve_gen_steps_linear(sk, m, start, end)
+                           : itersolve_gen_steps_range(sk, m, start, end));
             if (ret)
                 return ret;
             sk->last_move_time = last_flush_time = end;
@@ -182,7 +255,9 @@ itersolve_generate_steps(struct stepper_kinematics *sk, double flush_time)
             // Must generates steps just past stepper activity
             if (end > force_steps_time)
                 end = force_steps_time;
-            int32_t ret = itersolve_gen_steps_range(sk, m, start, end);
+            int32_t ret = (sk->is_linear
+                           ? itersolve_gen_steps_linear(sk, m, start, end)
+                           : itersolve_gen_steps_range(sk, m, start, end));
             if (ret)
                 return ret;
             last_flush_time = end;
@@ -199,7 +274,6 @@ itersolve_check_active(struct stepper_kinematics *sk, double flush_time)
 {
     if (!sk->tq)
         return 0.;
-    trapq_check_sentinels(sk->tq);
     struct move *m = list_first_entry(&sk->tq->moves, struct move, node);
     while (sk->last_flush_time >= m->print_time + m->move_t)
         m = list_next_entry(m, node);
@@ -260,3 +334,16 @@ itersolve_get_commanded_pos(struct stepper_kinematics *sk)
 {
     return sk->commanded_pos;
 }
+
+// Note that the stepper position is a linear function of the cartesian
+// coordinates (which enables the closed-form step time solver).  Pass
+// all zeros to use the iterative solver.
+void __visible
+itersolve_set_linear(struct stepper_kinematics *sk
+                     , double x, double y, double z)
+{
+    sk->linear_coef.x = x;
+    sk->linear_coef.y = y;
+    sk->linear_coef.z = z;
+    sk->is_linear = x || y || z;
+}
@@ -2,6 +2,7 @@
 #define ITERSOLVE_H
 
 #include <stdint.h> // int32_t
+#include "trapq.h" // struct coord
 
 enum {
     AF_X = 1 << 0, AF_Y = 1 << 1, AF_Z = 1 << 2,
@@ -23,6 +24,9 @@ struct stepper_kinematics {
 
     sk_calc_callback calc_position_cb;
     sk_post_callback post_cb;
+
+    int is_linear;
+    struct coord linear_coef;
 };
 
 int32_t itersolve_generate_steps(struct stepper_kinematics *sk
@@ -37,5 +41,7 @@ double itersolve_calc_position_from_coord(struct stepper_kinematics *sk
 void itersolve_set_position(struct stepper_kinematics *sk
                             , double x, double y, double z);
 double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
+void itersolve_set_linear(struct stepper_kinematics *sk
+                          , double x, double y, double z);
 
 #endif // itersolve.h
@@ -119,6 +119,8 @@ extruder_set_smooth_time(struct stepper_kinematics *sk, double smooth_time)
     double hst = smooth_time * .5;
     es->half_smooth_time = hst;
     es->sk.gen_steps_pre_active = es->sk.gen_steps_post_active = hst;
+    // Without pressure advance the extruder position is linear
+    itersolve_set_linear(sk, hst ? 0. : 1., 0., 0.);
     if (! hst)
         return;
     es->inv_half_smooth_time2 = 1. / (hst * hst);
@@ -131,5 +133,6 @@ extruder_stepper_alloc(void)
     memset(es, 0, sizeof(*es));
     es->sk.calc_position_cb = extruder_calc_position;
     es->sk.active_flags = AF_X;
+    itersolve_set_linear(&es->sk, 1., 0., 0.);
     return &es->sk;
 }
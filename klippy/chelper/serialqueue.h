@@ -55,9 +55,14 @@ void serialqueue_send_batch(struct serialqueue *sq, struct command_queue *cq
 void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
                       , uint8_t *msg, int len
                       , uint64_t min_clock, uint64_t req_clock);
+void serialqueue_send_multiple(struct serialqueue *sq, struct command_queue *cq
+                               , uint8_t *msgs, int *lens, int count
+                               , uint64_t min_clock, uint64_t req_clock);
 void serialqueue_encode_and_send(
     struct serialqueue *sq, struct command_queue *cq
     , uint32_t *data, int len, uint64_t min_clock, uint64_t req_clock);
+int serialqueue_pull_multiple(struct serialqueue *sq
+                              , struct pull_queue_message *q, int max);
 void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
 void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
 void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
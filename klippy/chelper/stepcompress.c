@@ -38,6 +38,9 @@ struct stepcompress {
     struct list_head msg_queue;
     uint32_t queue_step_msgid, set_next_step_dir_msgid, oid;
     int sdir, invert_sdir;
+    // Statistics
+    uint64_t step_count, queue_step_count;
+    double compress_time;
 };
 
 
@@ -267,11 +270,14 @@ stepcompress_flush(struct stepcompress *sc, uint64_t move_clock)
 {
     if (sc->queue_pos >= sc->queue_next)
         return 0;
+    double start_time = get_monotonic();
     while (sc->last_step_clock < move_clock) {
         struct step_move move = compress_bisect_add(sc);
         int ret = check_line(sc, move);
         if (ret)
             return ret;
+        sc->step_count += move.count;
+        sc->queue_step_count++;
 
         uint32_t msg[5] = {
             sc->queue_step_msgid, sc->oid, move.interval, move.count, move.add
@@ -289,6 +295,7 @@ stepcompress_flush(struct stepcompress *sc, uint64_t move_clock)
         }
         sc->queue_pos += move.count;
     }
+    sc->compress_time += get_monotonic() - start_time;
     return 0;
 }
 
@@ -304,6 +311,8 @@ stepcompress_flush_far(struct stepcompress *sc, uint64_t abs_step_clock)
     qm->min_clock = sc->last_step_clock;
     sc->last_step_clock = qm->req_clock = abs_step_clock;
     list_add_tail(&qm->node, &sc->msg_queue);
+    sc->step_count++;
+    sc->queue_step_count++;
     return 0;
 }
 
@@ -361,6 +370,16 @@ stepcompress_set_time(struct stepcompress *sc
     sc->mcu_freq = mcu_freq;
 }
 
+// Report the number of steps and queue_step commands generated
+void __visible
+stepcompress_get_stats(struct stepcompress *sc
+                       , struct stepcompress_stats *stats)
+{
+    stats->step_count = sc->step_count;
+    stats->queue_step_count = sc->queue_step_count;
+    stats->compress_time = sc->compress_time;
+}
+
 double
 stepcompress_get_mcu_freq(struct stepcompress *sc)
 {
@@ -12,6 +12,12 @@ void stepcompress_fill(struct stepcompress *sc, uint32_t max_error
 void stepcompress_free(struct stepcompress *sc);
 int stepcompress_reset(struct stepcompress *sc, uint64_t last_step_clock);
 int stepcompress_queue_msg(struct stepcompress *sc, uint32_t *data, int len);
+struct stepcompress_stats {
+    uint64_t step_count, queue_step_count;
+    double compress_time;
+};
+void stepcompress_get_stats(struct stepcompress *sc
+                            , struct stepcompress_stats *stats);
 double stepcompress_get_mcu_freq(struct stepcompress *sc);
 uint32_t stepcompress_get_oid(struct stepcompress *sc);
 int stepcompress_get_step_dir(struct stepcompress *sc);
@@ -11,6 +11,8 @@
 #include "compiler.h" // unlikely
 #include "trapq.h" // move_get_coord
 
+#define NEVER_TIME 9999999999999999.9
+
 // Allocate a new 'move' object
 struct move *
 move_alloc(void)
@@ -20,13 +22,34 @@ move_alloc(void)
     return m;
 }
 
-// Fill and add a move to the trapezoid velocity queue
-void __visible
-trapq_append(struct trapq *tq, double print_time
-             , double accel_t, double cruise_t, double decel_t
-             , double start_pos_x, double start_pos_y, double start_pos_z
-             , double axes_r_x, double axes_r_y, double axes_r_z
-             , double start_v, double cruise_v, double accel)
+// Update the list sentinels (called after moves are added so that the
+// step generation threads only ever read them)
+static void
+trapq_check_sentinels(struct trapq *tq)
+{
+    struct move *tail_sentinel = list_last_entry(&tq->moves, struct move, node);
+    if (tail_sentinel->print_time)
+        // Already up to date
+        return;
+    struct move *m = list_prev_entry(tail_sentinel, node);
+    struct move *head_sentinel = list_first_entry(&tq->moves, struct move,node);
+    if (m == head_sentinel) {
+        // No moves at all on this list
+        tail_sentinel->print_time = NEVER_TIME;
+        return;
+    }
+    tail_sentinel->print_time = m->print_time + m->move_t;
+    tail_sentinel->start_pos = move_get_coord(m, m->move_t);
+}
+
+// Fill and add a move to the trapezoid velocity queue (without
+// updating the sentinels)
+static void
+trapq_add_moves(struct trapq *tq, double print_time
+                , double accel_t, double cruise_t, double decel_t
+                , double start_pos_x, double start_pos_y, double start_pos_z
+                , double axes_r_x, double axes_r_y, double axes_r_z
+                , double start_v, double cruise_v, double accel)
 {
     struct coord start_pos = { .x=start_pos_x, .y=start_pos_y, .z=start_pos_z };
     struct coord axes_r = { .x=axes_r_x, .y=axes_r_y, .z=axes_r_z };
@@ -68,6 +91,35 @@ trapq_append(struct trapq *tq, double print_time
     }
 }
 
+// Fill and add a move to the trapezoid velocity queue
+void __visible
+trapq_append(struct trapq *tq, double print_time
+             , double accel_t, double cruise_t, double decel_t
+             , double start_pos_x, double start_pos_y, double start_pos_z
+             , double axes_r_x, double axes_r_y, double axes_r_z
+             , double start_v, double cruise_v, double accel)
+{
+    trapq_add_moves(tq, print_time, accel_t, cruise_t, decel_t
+                    , start_pos_x, start_pos_y, start_pos_z
+                    , axes_r_x, axes_r_y, axes_r_z
+                    , start_v, cruise_v, accel);
+    trapq_check_sentinels(tq);
+}
+
+// Add a batch of moves to the trapezoid velocity queue.  The 'moves'
+// array contains 'count' records of TRAPQ_APPEND_SIZE doubles each
+// (using the same order as the trapq_append() parameters).
+void __visible
+trapq_append_batch(struct trapq *tq, double *moves, int count)
+{
+    for (; count > 0; count--, moves += TRAPQ_APPEND_SIZE)
+        trapq_add_moves(tq, moves[0], moves[1], moves[2], moves[3]
+                        , moves[4], moves[5], moves[6]
+                        , moves[7], moves[8], moves[9]
+                        , moves[10], moves[11], moves[12]);
+    trapq_check_sentinels(tq);
+}
+
 // Return the distance moved given a time in a move
 inline double
 move_get_distance(struct move *m, double move_time)
@@ -86,8 +138,6 @@ move_get_coord(struct move *m, double move_time)
         .z = m->start_pos.z + m->axes_r.z * move_dist };
 }
 
-#define NEVER_TIME 9999999999999999.9
-
 // Allocate a new 'trapq' object
 struct trapq * __visible
 trapq_alloc(void)
@@ -114,25 +164,6 @@ trapq_free(struct trapq *tq)
     free(tq);
 }
 
-// Update the list sentinels
-void
-trapq_check_sentinels(struct trapq *tq)
-{
-    struct move *tail_sentinel = list_last_entry(&tq->moves, struct move, node);
-    if (tail_sentinel->print_time)
-        // Already up to date
-        return;
-    struct move *m = list_prev_entry(tail_sentinel, node);
-    struct move *head_sentinel = list_first_entry(&tq->moves, struct move,node);
-    if (m == head_sentinel) {
-        // No moves at all on this list
-        tail_sentinel->print_time = NEVER_TIME;
-        return;
-    }
-    tail_sentinel->print_time = m->print_time + m->move_t;
-    tail_sentinel->start_pos = move_get_coord(m, m->move_t);
-}
-
 #define MAX_NULL_MOVE 1.0
 
 // Add a move to the trapezoid velocity queue
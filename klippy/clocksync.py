@@ -8,6 +8,12 @@ import logging, math
 RTT_AGE = .000010 / (60. * 60.)
 DECAY = 1. / 30.
 TRANSMIT_EXTRA = .001
+# Use an unusual time for clock queries so clock messages don't
+# resonate with other periodic events.
+QUERY_TIME = .9839
+QUERY_TIME_MIN = QUERY_TIME / 4.
+QUERY_TIME_MAX = QUERY_TIME * 2.
+STABLE_DECAY = 1. / 300.
 
 class ClockSync:
     def __init__(self, reactor):
@@ -26,7 +32,11 @@ class ClockSync:
         self.time_avg = self.time_variance = 0.
         self.clock_avg = self.clock_covariance = 0.
         self.prediction_variance = 0.
-        self.last_prediction_time = 0.
+        self.last_prediction_time = self.last_sample_time = 0.
+        # Telemetry and adaptive query rate tracking
+        self.query_time = QUERY_TIME
+        self.stable_variance = 0.
+        self.last_rtt = self.rtt_avg = 0.
     def connect(self, serial):
         self.serial = serial
         self.mcu_freq = serial.msgparser.get_constant_float('CLOCK_FREQ')
@@ -34,9 +44,10 @@ class ClockSync:
         params = serial.send_with_response('get_uptime', 'uptime')
         self.last_clock = (params['high'] << 32) | params['clock']
         self.clock_avg = self.last_clock
-        self.time_avg = params['#sent_time']
+        self.time_avg = self.last_sample_time = params['#sent_time']
         self.clock_est = (self.time_avg, self.clock_avg, self.mcu_freq)
         self.prediction_variance = (.001 * self.mcu_freq)**2
+        self.stable_variance = self.prediction_variance
         # Enable periodic get_clock timer
         for i in range(8):
             params = serial.send_with_response('get_clock', 'clock')
@@ -58,9 +69,13 @@ class ClockSync:
     def _get_clock_event(self, eventtime):
         self.serial.raw_send(self.get_clock_cmd, 0, 0, self.cmd_queue)
         self.queries_pending += 1
-        # Use an unusual time for the next event so clock messages
-        # don't resonate with other periodic events.
-        return eventtime + .9839
+        # Query faster while the prediction variance is above its long
+        # term level and back off while it is stable
+        if self.prediction_variance > 4. * self.stable_variance:
+            self.query_time = max(.5 * self.query_time, QUERY_TIME_MIN)
+        elif self.prediction_variance < 1.5 * self.stable_variance:
+            self.query_time = min(1.1 * self.query_time, QUERY_TIME_MAX)
+        return eventtime + self.query_time
     def _handle_clock(self, params):
         self.queries_pending = 0
         # Extend clock to 64bit
@@ -74,6 +89,13 @@ class ClockSync:
         if not sent_time:
             return
         receive_time = params['#receive_time']
+        # Samples are weighted by the time since the previous sample (so
+        # the regression covers the same time span at any query rate)
+        elapsed = sent_time - self.last_sample_time
+        decay = DECAY * min(max(elapsed, QUERY_TIME_MIN),
+                            QUERY_TIME_MAX) / QUERY_TIME
+        self.last_rtt = receive_time - sent_time
+        self.rtt_avg += decay * (self.last_rtt - self.rtt_avg)
         half_rtt = .5 * (receive_time - sent_time)
         aged_rtt = (sent_time - self.min_rtt_time) * RTT_AGE
         if half_rtt < self.min_half_rtt + aged_rtt:
@@ -101,16 +123,23 @@ class ClockSync:
         else:
             self.last_prediction_time = sent_time
             self.prediction_variance = (
-                (1. - DECAY) * (self.prediction_variance + clock_diff2 * DECAY))
+                (1. - decay) * (self.prediction_variance + clock_diff2 * decay))
+        # Track the long term (stable) level of the prediction variance
+        if self.prediction_variance < self.stable_variance:
+            self.stable_variance = self.prediction_variance
+        else:
+            self.stable_variance += STABLE_DECAY * (
+                self.prediction_variance - self.stable_variance)
         # Add clock and sent_time to linear regression
+        self.last_sample_time = sent_time
         diff_sent_time = sent_time - self.time_avg
-        self.time_avg += DECAY * diff_sent_time
-        self.time_variance = (1. - DECAY) * (
-            self.time_variance + diff_sent_time**2 * DECAY)
+        self.time_avg += decay * diff_sent_time
+        self.time_variance = (1. - decay) * (
+            self.time_variance + diff_sent_time**2 * decay)
         diff_clock = clock - self.clock_avg
-        self.clock_avg += DECAY * diff_clock
-        self.clock_covariance = (1. - DECAY) * (
-            self.clock_covariance + diff_sent_time * diff_clock * DECAY)
+        self.clock_avg += decay * diff_clock
+        self.clock_covariance = (1. - decay) * (
+            self.clock_covariance + diff_sent_time * diff_clock * decay)
         # Update prediction from linear regression
         new_freq = self.clock_covariance / self.time_variance
         pred_stddev = math.sqrt(self.prediction_variance)
@@ -144,7 +173,8 @@ class ClockSync:
             return last_clock + 0x100000000 - clock_diff
         return last_clock - clock_diff
     def is_active(self):
-        return self.queries_pending <= 4
+        # Allow about 4 seconds of queries without a response
+        return self.queries_pending * self.query_time <= 4. * QUERY_TIME
     def dump_debug(self):
         sample_time, clock, freq = self.clock_est
         return ("clocksync state: mcu_freq=%d last_clock=%d"
@@ -156,9 +186,31 @@ class ClockSync:
                     self.time_avg, self.time_variance,
                     self.clock_avg, self.clock_covariance,
                     self.prediction_variance))
+    def get_min_rtt(self):
+        if not self.min_rtt_time:
+            return 0.
+        return 2. * self.min_half_rtt
+    def get_freq_drift(self):
+        # Deviation (in ppm) of the estimated frequency from CLOCK_FREQ
+        sample_time, clock, freq = self.clock_est
+        if not freq:
+            # No clock estimate yet
+            return 0.
+        return (freq / self.mcu_freq - 1.) * 1000000.
+    def get_status(self, eventtime):
+        return {'rtt': self.rtt_avg, 'rtt_last': self.last_rtt,
+                'rtt_min': self.get_min_rtt(),
+                'prediction_stddev': (math.sqrt(self.prediction_variance)
+                                      / self.mcu_freq),
+                'freq': self.clock_est[2], 'freq_drift': self.get_freq_drift(),
+                'query_time': self.query_time}
     def stats(self, eventtime):
         sample_time, clock, freq = self.clock_est
-        return "freq=%d" % (freq,)
+        return ("freq=%d rtt=%.6f rtt_min=%.6f clock_stddev=%.6f"
+                " freq_drift=%.3f query_time=%.3f" % (
+                    freq, self.rtt_avg, self.get_min_rtt(),
+                    math.sqrt(self.prediction_variance) / self.mcu_freq,
+                    self.get_freq_drift(), self.query_time))
     def calibrate_clock(self, print_time, eventtime):
         return (0., self.mcu_freq)
 
@@ -196,9 +248,20 @@ class SecondarySync(ClockSync):
         adjusted_offset, adjusted_freq = self.clock_adj
         return "%s clock_adj=(%.3f %.3f)" % (
             ClockSync.dump_debug(self), adjusted_offset, adjusted_freq)
+    def get_sync_drift(self):
+        # Drift (in ppm) of this mcu's clock relative to the main mcu
+        if not self.clock_est[2] or not self.main_sync.clock_est[2]:
+            return 0.
+        return self.get_freq_drift() - self.main_sync.get_freq_drift()
+    def get_status(self, eventtime):
+        res = ClockSync.get_status(self, eventtime)
+        res['sync_drift'] = self.get_sync_drift()
+        return res
     def stats(self, eventtime):
         adjusted_offset, adjusted_freq = self.clock_adj
-        return "%s adj=%d" % (ClockSync.stats(self, eventtime), adjusted_freq)
+        return "%s adj=%d sync_drift=%.3f" % (
+            ClockSync.stats(self, eventtime), adjusted_freq,
+            self.get_sync_drift())
     def calibrate_clock(self, print_time, eventtime):
         # Calculate: est_print_time = main_sync.estimatated_print_time()
         ser_time, ser_clock, ser_freq = self.main_sync.clock_est
@@ -90,6 +90,14 @@ class MCU_SPI:
             return
         self.spi_send_cmd.send([self.oid, data],
                                minclock=minclock, reqclock=reqclock)
+    def spi_send_batch(self, data_list, minclock=0, reqclock=0):
+        if self.spi_send_cmd is None:
+            for data in data_list:
+                self.spi_send(data)
+            return
+        cmds = [self.spi_send_cmd.encode([self.oid, data])
+                for data in data_list]
+        self.spi_send_cmd.send_batch(cmds, minclock=minclock, reqclock=reqclock)
     def spi_transfer(self, data):
         return self.spi_transfer_cmd.send_with_response(
             [self.oid, data], 'spi_transfer_response', self.oid)
@@ -48,14 +48,19 @@ class HD44780:
             "hd44780_send_cmds oid=%c cmds=%*s", cq=cmd_queue)
         self.send_data_cmd = self.mcu.lookup_command(
             "hd44780_send_data oid=%c data=%*s", cq=cmd_queue)
-    def send(self, cmds, is_data=False):
+    def encode(self, cmds, is_data=False):
         cmd_type = self.send_cmds_cmd
         if is_data:
             cmd_type = self.send_data_cmd
-        cmd_type.send([self.oid, cmds], reqclock=BACKGROUND_PRIORITY_CLOCK)
         #logging.debug("hd44780 %d %s", is_data, repr(cmds))
+        return cmd_type.encode([self.oid, cmds])
+    def send(self, cmds, is_data=False):
+        self.send_batch([self.encode(cmds, is_data)])
+    def send_batch(self, msgs):
+        self.send_cmds_cmd.send_batch(msgs, reqclock=BACKGROUND_PRIORITY_CLOCK)
     def flush(self):
         # Find all differences in the framebuffers and send them to the chip
+        msgs = []
         for new_data, old_data, fb_id in self.all_framebuffers:
             if new_data == old_data:
                 continue
@@ -72,9 +77,10 @@ class HD44780:
             # Transmit changes
             for pos, count in diffs:
                 chip_pos = pos
-                self.send([fb_id + chip_pos])
-                self.send(new_data[pos:pos+count], is_data=True)
+                msgs.append(self.encode([fb_id + chip_pos]))
+                msgs.append(self.encode(new_data[pos:pos+count], is_data=True))
             old_data[:] = new_data
+        self.send_batch(msgs)
     def init(self):
         curtime = self.printer.get_reactor().monotonic()
         print_time = self.mcu.estimated_print_time(curtime)
@@ -58,7 +58,7 @@ class ST7920:
             "st7920_send_cmds oid=%c cmds=%*s", cq=cmd_queue)
         self.send_data_cmd = self.mcu.lookup_command(
             "st7920_send_data oid=%c data=%*s", cq=cmd_queue)
-    def send(self, cmds, is_data=False, is_extended=False):
+    def encode(self, cmds, is_data=False, is_extended=False):
         cmd_type = self.send_cmds_cmd
         if is_data:
             cmd_type = self.send_data_cmd
@@ -68,10 +68,15 @@ class ST7920:
                 add_cmd = 0x26
             cmds = [add_cmd] + cmds
             self.is_extended = is_extended
-        cmd_type.send([self.oid, cmds], reqclock=BACKGROUND_PRIORITY_CLOCK)
         #logging.debug("st7920 %d %s", is_data, repr(cmds))
+        return cmd_type.encode([self.oid, cmds])
+    def send(self, cmds, is_data=False, is_extended=False):
+        self.send_batch([self.encode(cmds, is_data, is_extended)])
+    def send_batch(self, msgs):
+        self.send_cmds_cmd.send_batch(msgs, reqclock=BACKGROUND_PRIORITY_CLOCK)
     def flush(self):
         # Find all differences in the framebuffers and send them to the chip
+        msgs = []
         for new_data, old_data, fb_id in self.all_framebuffers:
             if new_data == old_data:
                 continue
@@ -93,11 +98,13 @@ class ST7920:
                 chip_pos = pos >> 1
                 if fb_id < 0x40:
                     # Graphics framebuffer update
-                    self.send([0x80 + fb_id, 0x80 + chip_pos], is_extended=True)
+                    msgs.append(self.encode([0x80 + fb_id, 0x80 + chip_pos],
+                                            is_extended=True))
                 else:
-                    self.send([fb_id + chip_pos])
-                self.send(new_data[pos:pos+count], is_data=True)
+                    msgs.append(self.encode([fb_id + chip_pos]))
+                msgs.append(self.encode(new_data[pos:pos+count], is_data=True))
             old_data[:] = new_data
+        self.send_batch(msgs)
     def init(self):
         cmds = [0x24, # Enter extended mode
                 0x40, # Clear vertical scroll address
@@ -0,0 +1,285 @@
+# Compiled (pre-parsed) g-code file support for virtual_sdcard
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, struct, bisect, logging
+import gcode
+
+# A compiled file starts with a header identifying the source file
+# that it was generated from.  It is followed by one record per
+# source line.  Each record starts with an opcode, a parameter mask,
+# and the number of bytes the line occupies in the source file.  The
+# records are followed by a seek table containing the (source
+# position, compiled position) of every SEEK_INTERVAL'th record.
+HEADER = struct.Struct('<4sHHQdQ')
+HEADER_MAGIC = 'KGCB'
+HEADER_VERSION = 2
+RECORD = struct.Struct('<BBH')
+TEXT_RECORD = struct.Struct('<II')
+SEEK_ENTRY = struct.Struct('<QQ')
+SEEK_INTERVAL = 1024
+
+OP_TEXT, OP_SKIP, OP_G0, OP_G1 = range(4)
+MOVE_COMMANDS = {'G0': OP_G0, 'G1': OP_G1}
+MOVE_PARAMS = 'XYZEF'
+MAX_SOURCE_LEN = 0xffff
+
+CHUNK_SIZE = 65536
+
+class error(Exception):
+    pass
+
+def get_compiled_filename(filename):
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, '.' + basename + '.kgc')
+
+def _build_move_formats():
+    formats = []
+    for mask in range(1 << len(MOVE_PARAMS)):
+        keys = tuple([p for i, p in enumerate(MOVE_PARAMS)
+                      if mask & (1 << i)])
+        formats.append((struct.Struct('<' + 'd' * len(keys)), keys))
+    return formats
+MOVE_FORMATS = _build_move_formats()
+
+
+######################################################################
+# Compiling
+######################################################################
+
+# Encode a single source line (without its trailing newline)
+def compile_line(line):
+    src_len = len(line) + 1
+    if src_len > MAX_SOURCE_LEN:
+        return _compile_text(line, src_len)
+    cmdline = line.strip()
+    cpos = cmdline.find(';')
+    if cpos >= 0:
+        cmdline = cmdline[:cpos]
+    cmdline = cmdline.upper()
+    if not cmdline.strip():
+        return RECORD.pack(OP_SKIP, 0, src_len)
+    if gcode.GCodeParser.traditional_r.match(cmdline) is None:
+        return _compile_text(line, src_len)
+    words = cmdline.split()
+    opcode = MOVE_COMMANDS.get(words[0])
+    if opcode is None:
+        return _compile_text(line, src_len)
+    params = {}
+    for w in words[1:]:
+        if w[0] not in MOVE_PARAMS:
+            return _compile_text(line, src_len)
+        try:
+            params[w[0]] = float(w[1:])
+        except ValueError:
+            return _compile_text(line, src_len)
+    if params.get('F', 1.) <= 0.:
+        # Let the g-code handler report the error on the original text
+        return _compile_text(line, src_len)
+    mask = 0
+    for i, p in enumerate(MOVE_PARAMS):
+        if p in params:
+            mask |= 1 << i
+    st, keys = MOVE_FORMATS[mask]
+    return (RECORD.pack(opcode, mask, src_len)
+            + st.pack(*[params[k] for k in keys]))
+
+def _compile_text(line, src_len):
+    return (RECORD.pack(OP_TEXT, 0, 0)
+            + TEXT_RECORD.pack(src_len, len(line)) + line)
+
+# Convert a g-code file into its compiled form
+def compile_file(filename, dest_filename=None):
+    if dest_filename is None:
+        dest_filename = get_compiled_filename(filename)
+    st = os.stat(filename)
+    temp_filename = dest_filename + '.tmp'
+    src = open(filename, 'rb')
+    dest = open(temp_filename, 'wb')
+    try:
+        dest.write(HEADER.pack(HEADER_MAGIC, HEADER_VERSION, 0,
+                               st.st_size, st.st_mtime, 0))
+        seek_table = []
+        line_count = src_pos = 0
+        pos = HEADER.size
+        partial_input = ""
+        while 1:
+            data = src.read(CHUNK_SIZE)
+            if not data:
+                break
+            lines = data.split('\n')
+            lines[0] = partial_input + lines[0]
+            partial_input = lines.pop()
+            records = []
+            for line in lines:
+                if not line_count % SEEK_INTERVAL:
+                    seek_table.append(SEEK_ENTRY.pack(src_pos, pos))
+                record = compile_line(line)
+                records.append(record)
+                line_count += 1
+                src_pos += len(line) + 1
+                pos += len(record)
+            dest.write(''.join(records))
+        # Write the seek table and note its location in the header
+        dest.write(''.join(seek_table))
+        dest.seek(0)
+        dest.write(HEADER.pack(HEADER_MAGIC, HEADER_VERSION, 0,
+                               st.st_size, st.st_mtime, pos))
+    finally:
+        src.close()
+        dest.close()
+    os.rename(temp_filename, dest_filename)
+    return dest_filename
+
+
+######################################################################
+# Replay
+######################################################################
+
+# Params dictionary for a compiled move - the original text is only
+# regenerated if a handler requests it (eg, for an error message)
+class CompiledMoveParams(dict):
+    def __missing__(self, key):
+        if key == '#original':
+            return ' '.join([self['#command']] + [
+                '%s%s' % (k, repr(self[k])) for k in MOVE_PARAMS if k in self])
+        raise KeyError(key)
+
+class CompiledReader:
+    def __init__(self, f, source_size, source_mtime):
+        # The file object may return more data than requested
+        self.file = f
+        try:
+            data = f.read(HEADER.size)
+            if len(data) < HEADER.size:
+                raise error("Truncated compiled file")
+            magic, version, x, size, mtime, table_pos = HEADER.unpack_from(
+                data)
+            if magic != HEADER_MAGIC or version != HEADER_VERSION:
+                raise error("Unknown compiled file format")
+            if size != source_size or mtime != source_mtime:
+                raise error("Compiled file does not match source file")
+            self.records_end = table_pos
+            # An empty source file has no seek table entries
+            self.seek_table = (self._read_seek_table(table_pos)
+                               or [(0, HEADER.size)])
+        except:
+            f.close()
+            raise
+        self.seek_src_pos = [sp for sp, cp in self.seek_table]
+        self.partial = ""
+        self.pending = []
+        self.src_pos = 0
+        f.seek(HEADER.size)
+    def _read_seek_table(self, table_pos):
+        self.file.seek(table_pos)
+        data = []
+        while 1:
+            d = self.file.read(CHUNK_SIZE)
+            if not d:
+                break
+            data.append(d)
+        data = ''.join(data)
+        if len(data) % SEEK_ENTRY.size:
+            raise error("Invalid compiled file seek table")
+        return [SEEK_ENTRY.unpack_from(data, pos)
+                for pos in range(0, len(data), SEEK_ENTRY.size)]
+    def close(self):
+        self.file.close()
+    def _decode(self, data):
+        # Decode all complete records in data, return (records, used)
+        out = []
+        pos = 0
+        dlen = len(data)
+        src_pos = self.src_pos
+        move_formats = MOVE_FORMATS
+        while pos + RECORD.size <= dlen:
+            opcode, mask, src_len = RECORD.unpack_from(data, pos)
+            rpos = pos + RECORD.size
+            if opcode == OP_G1 or opcode == OP_G0:
+                st, keys = move_formats[mask]
+                end = rpos + st.size
+                if end > dlen:
+                    break
+                params = CompiledMoveParams(zip(keys, st.unpack_from(
+                    data, rpos)))
+                if opcode == OP_G1:
+                    params['G'] = '1'
+                    params['#command'] = 'G1'
+                else:
+                    params['G'] = '0'
+                    params['#command'] = 'G0'
+                out.append((src_len, None, params))
+            elif opcode == OP_SKIP:
+                end = rpos
+                out.append((src_len, None, None))
+            elif opcode == OP_TEXT:
+                if rpos + TEXT_RECORD.size > dlen:
+                    break
+                src_len, text_len = TEXT_RECORD.unpack_from(data, rpos)
+                tpos = rpos + TEXT_RECORD.size
+                end = tpos + text_len
+                if end > dlen:
+                    break
+                out.append((src_len, data[tpos:end], None))
+            else:
+                raise error("Invalid compiled file opcode %d" % (opcode,))
+            pos = end
+            src_pos += src_len
+        self.src_pos = src_pos
+        return out, pos
+    def read_commands(self):
+        # Return a list of (source_len, script, params) tuples - an
+        # empty list is returned at end of file
+        if self.pending:
+            out = self.pending
+            self.pending = []
+            return out
+        while 1:
+            data = self.file.read(CHUNK_SIZE)
+            # Don't decode the seek table that follows the records
+            excess = self.file.tell() - self.records_end
+            if excess > 0:
+                data = data[:max(len(data) - excess, 0)]
+            if not data:
+                return []
+            data = self.partial + data
+            out, used = self._decode(data)
+            self.partial = data[used:]
+            if out:
+                return out
+    def seek(self, src_pos):
+        # Position the reader at the line starting at the given source
+        # file offset.  Returns False if src_pos is not a line start.
+        idx = max(bisect.bisect_right(self.seek_src_pos, src_pos) - 1, 0)
+        cp_src_pos, cp_pos = self.seek_table[idx]
+        self.file.seek(cp_pos)
+        self.partial = ""
+        self.pending = []
+        self.src_pos = cp_src_pos
+        cur_pos = cp_src_pos
+        while cur_pos < src_pos:
+            records = self.read_commands()
+            if not records:
+                return False
+            for i, (src_len, script, params) in enumerate(records):
+                if cur_pos == src_pos:
+                    self.pending = records[i:]
+                    return True
+                cur_pos += src_len
+        return cur_pos == src_pos
+
+def open_compiled(filename, opener=open):
+    # Open the compiled version of a g-code file (if it is up to date)
+    compiled_filename = get_compiled_filename(filename)
+    if not os.path.exists(compiled_filename):
+        return None
+    try:
+        st = os.stat(filename)
+        f = opener(compiled_filename, 'rb')
+        return CompiledReader(f, st.st_size, st.st_mtime)
+    except (error, IOError, OSError) as e:
+        logging.info("Unable to use compiled file %s: %s",
+                     compiled_filename, str(e))
+        return None
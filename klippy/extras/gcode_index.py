@@ -0,0 +1,225 @@
+# Line and layer index of g-code files for virtual_sdcard
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, json, bisect, logging
+
+INDEX_VERSION = 1
+LINE_INTERVAL = 1000
+CHUNK_SIZE = 65536
+LAYER_Z_EPSILON = .000001
+
+class error(Exception):
+    pass
+
+def get_index_filename(filename):
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, '.' + basename + '.idx')
+
+
+######################################################################
+# Index generation
+######################################################################
+
+class IndexBuilder:
+    def __init__(self):
+        self.line_count = self.position = 0
+        self.line_offsets = []
+        self.layers = []
+        # G-Code state tracking
+        self.absolute_coord = self.absolute_extrude = True
+        self.z_pos = self.e_pos = self.extruded = 0.
+        self.layer_z = None
+        self.z_change = None
+    def _get_state(self):
+        return [self.position, self.line_count, self.e_pos, self.extruded,
+                self.absolute_coord, self.absolute_extrude]
+    def _process_move(self, words):
+        new_z = new_e = None
+        for w in words[1:]:
+            try:
+                if w[0] == 'Z':
+                    new_z = float(w[1:])
+                elif w[0] == 'E':
+                    new_e = float(w[1:])
+            except ValueError:
+                return
+        if new_z is not None:
+            if not self.absolute_coord:
+                new_z += self.z_pos
+            if new_z != self.z_pos:
+                # Note the state prior to the z change (a possible layer start)
+                self.z_change = self._get_state()
+                self.z_pos = new_z
+        if new_e is not None:
+            if not self.absolute_coord or not self.absolute_extrude:
+                new_e += self.e_pos
+            delta_e = new_e - self.e_pos
+            if delta_e > 0.:
+                if (self.layer_z is None
+                    or self.z_pos > self.layer_z + LAYER_Z_EPSILON):
+                    # First extrusion at a new height starts a new layer
+                    self.layer_z = self.z_pos
+                    state = self.z_change
+                    if state is None:
+                        state = self._get_state()
+                    self.layers.append([self.z_pos] + state)
+                self.z_change = None
+            self.extruded += delta_e
+            self.e_pos = new_e
+    def _process_line(self, line):
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        words = line.upper().split()
+        if not words:
+            return
+        cmd = words[0]
+        if cmd == 'G1' or cmd == 'G0':
+            self._process_move(words)
+        elif cmd == 'G92':
+            for w in words[1:]:
+                if w[0] == 'E':
+                    try:
+                        self.e_pos = float(w[1:])
+                    except ValueError:
+                        pass
+                elif w[0] == 'Z':
+                    try:
+                        self.z_pos = float(w[1:])
+                    except ValueError:
+                        pass
+            if len(words) == 1:
+                self.e_pos = self.z_pos = 0.
+        elif cmd == 'G90':
+            self.absolute_coord = True
+        elif cmd == 'G91':
+            self.absolute_coord = False
+        elif cmd == 'M82':
+            self.absolute_extrude = True
+        elif cmd == 'M83':
+            self.absolute_extrude = False
+    def add_lines(self, lines):
+        for line in lines:
+            if not self.line_count % LINE_INTERVAL:
+                self.line_offsets.append(self.position)
+            self._process_line(line)
+            self.line_count += 1
+            self.position += len(line) + 1
+    def get_data(self):
+        return {'line_count': self.line_count, 'line_interval': LINE_INTERVAL,
+                'line_offsets': self.line_offsets, 'layers': self.layers}
+
+def build_index(filename, dest_filename=None):
+    if dest_filename is None:
+        dest_filename = get_index_filename(filename)
+    st = os.stat(filename)
+    builder = IndexBuilder()
+    f = open(filename, 'rb')
+    try:
+        partial_input = ""
+        while 1:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            lines = data.split('\n')
+            lines[0] = partial_input + lines[0]
+            partial_input = lines.pop()
+            builder.add_lines(lines)
+    finally:
+        f.close()
+    data = builder.get_data()
+    data.update({'version': INDEX_VERSION, 'size': st.st_size,
+                 'mtime': st.st_mtime})
+    temp_filename = dest_filename + '.tmp'
+    f = open(temp_filename, 'wb')
+    try:
+        json.dump(data, f, separators=(',', ':'))
+    finally:
+        f.close()
+    os.rename(temp_filename, dest_filename)
+    return GCodeIndex(filename, data)
+
+
+######################################################################
+# Index lookups
+######################################################################
+
+class GCodeIndex:
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.size = data['size']
+        self.mtime = data['mtime']
+        self.line_count = data['line_count']
+        self.line_interval = data['line_interval']
+        self.line_offsets = data['line_offsets']
+        self.layers = data['layers']
+        self.layer_offsets = [l[1] for l in self.layers]
+    def get_line_count(self):
+        return self.line_count
+    def get_layer_count(self):
+        return len(self.layers)
+    def get_layer(self, layer_num):
+        # Return info on the given layer (the first layer is 1)
+        if layer_num < 1 or layer_num > len(self.layers):
+            raise error("Layer %d not in file (%d layers)" % (
+                layer_num, len(self.layers)))
+        z, offset, line, e_pos, extruded, abs_coord, abs_extrude = (
+            self.layers[layer_num - 1])
+        return {'z': z, 'offset': offset, 'line': line, 'e_pos': e_pos,
+                'extruded': extruded, 'absolute_coord': abs_coord,
+                'absolute_extrude': abs_extrude}
+    def find_layer(self, offset):
+        # Return the layer number containing the given file offset
+        return bisect.bisect_right(self.layer_offsets, offset)
+    def find_line(self, offset):
+        # Return the line number (starting at 0) containing the offset
+        idx = min(bisect.bisect_right(self.line_offsets, offset) - 1,
+                  len(self.line_offsets) - 1)
+        if idx < 0:
+            return 0
+        start_offset = self.line_offsets[idx]
+        f = open(self.filename, 'rb')
+        try:
+            f.seek(start_offset)
+            data = f.read(offset - start_offset)
+        finally:
+            f.close()
+        return idx * self.line_interval + data.count('\n')
+    def find_line_offset(self, line):
+        # Return the file offset of the start of the given line
+        if line < 0 or line >= self.line_count:
+            raise error("Line %d not in file (%d lines)" % (
+                line, self.line_count))
+        idx = line // self.line_interval
+        offset = self.line_offsets[idx]
+        f = open(self.filename, 'rb')
+        try:
+            f.seek(offset)
+            for i in range(line - idx * self.line_interval):
+                offset += len(f.readline())
+        finally:
+            f.close()
+        return offset
+
+def load_index(filename):
+    # Load the index of a g-code file (if it is up to date)
+    index_filename = get_index_filename(filename)
+    if not os.path.exists(index_filename):
+        return None
+    try:
+        st = os.stat(filename)
+        f = open(index_filename, 'rb')
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+        if data.get('version') != INDEX_VERSION:
+            raise error("Unknown index version")
+        if data['size'] != st.st_size or data['mtime'] != st.st_mtime:
+            raise error("Index does not match file")
+        return GCodeIndex(filename, data)
+    except (error, IOError, OSError, ValueError, KeyError) as e:
+        logging.info("Unable to use index %s: %s", index_filename, str(e))
+        return None
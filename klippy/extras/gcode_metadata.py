@@ -0,0 +1,223 @@
+# Catalog of g-code files (and their slicer metadata) for virtual_sdcard
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, re, json, stat, threading, logging
+
+CATALOG_FILENAME = '.klipper_catalog.json'
+CATALOG_VERSION = 2
+SCAN_SIZE = 65536
+
+
+######################################################################
+# Slicer metadata extraction
+######################################################################
+
+def _parse_duration(value):
+    total = 0.
+    for amount, unit in re.findall(r'([0-9.]+)\s*([a-z]+)', value.lower()):
+        total += float(amount) * {'d': 86400., 'h': 3600., 'm': 60.}.get(
+            unit[0], 1.)
+    return total
+
+def _parse_sum(value):
+    return sum([float(v) for v in value.split(',') if v.strip()])
+
+# Regular expressions for metadata in the comments of common slicers
+METADATA_PARSERS = [
+    ('slicer', re.compile(r'^;\s*generated (?:with|by) (\S+)', re.I | re.M),
+     (lambda v: v.split('_')[0])),
+    ('slicer', re.compile(r'^;\s*g-code generated by (\S+?)\(', re.I | re.M),
+     str),
+    # Cura
+    ('estimated_time', re.compile(r'^;TIME:([0-9.]+)', re.M), float),
+    ('filament_used', re.compile(r'^;Filament used:\s*(.+)$', re.M),
+     (lambda v: _parse_sum(v.replace('m', '')) * 1000.)),
+    ('layer_count', re.compile(r'^;LAYER_COUNT:([0-9]+)', re.M), int),
+    # PrusaSlicer / Slic3r
+    ('estimated_time', re.compile(
+        r'^; estimated printing time(?: \(normal mode\))? = (.+)$', re.M),
+     _parse_duration),
+    ('filament_used', re.compile(
+        r'^; filament used \[mm\] = ([0-9., ]+)$', re.M), _parse_sum),
+    ('layer_count', re.compile(r'^; total layers count = ([0-9]+)', re.M),
+     int),
+    # Simplify3D
+    ('estimated_time', re.compile(r'^;\s*Build time: (.+)$', re.M),
+     _parse_duration),
+    ('filament_used', re.compile(r'^;\s*Filament length: ([0-9.]+) mm', re.M),
+     float),
+]
+
+def parse_metadata(filename):
+    # Extract slicer metadata from the start and end of a g-code file
+    f = open(filename, 'rb')
+    try:
+        data = f.read(SCAN_SIZE)
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size > SCAN_SIZE:
+            f.seek(max(size - SCAN_SIZE, SCAN_SIZE))
+            data += '\n' + f.read()
+    finally:
+        f.close()
+    metadata = {}
+    for name, regex, parser in METADATA_PARSERS:
+        if name in metadata:
+            continue
+        m = regex.search(data)
+        if m is None:
+            continue
+        try:
+            value = parser(m.group(1).strip())
+        except ValueError:
+            continue
+        if isinstance(value, str):
+            # The file contents may use any encoding
+            value = value.decode('utf-8', 'replace')
+        metadata[name] = value
+    return metadata
+
+
+######################################################################
+# File catalog
+######################################################################
+
+# File names are byte strings that may use any encoding - they are
+# stored in the catalog as latin-1 text so that they round trip exactly
+def _encode_name(fname):
+    return fname.decode('latin-1')
+
+def _decode_name(name):
+    return name.encode('latin-1')
+
+class FileCatalog:
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.catalog_filename = os.path.join(dirname, CATALOG_FILENAME)
+        self.lock = threading.Lock()
+        # files[fname] = [size, mtime, metadata]
+        self.files = {}
+        self.pending = []
+        self.is_scanning = False
+        self._load()
+    def _load(self):
+        if not os.path.exists(self.catalog_filename):
+            return
+        try:
+            f = open(self.catalog_filename, 'rb')
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+            if data.get('version') != CATALOG_VERSION:
+                return
+            self.files = {_decode_name(name): info
+                          for name, info in data['files'].items()}
+        except (IOError, OSError, ValueError, KeyError, AttributeError):
+            logging.exception("Unable to load file catalog %s",
+                              self.catalog_filename)
+    def _save(self):
+        try:
+            with self.lock:
+                files = {_encode_name(fname): info
+                         for fname, info in self.files.items()}
+                data = json.dumps({'version': CATALOG_VERSION,
+                                   'files': files}, separators=(',', ':'))
+        except (ValueError, TypeError):
+            logging.exception("Unable to encode file catalog %s",
+                              self.catalog_filename)
+            return
+        temp_filename = self.catalog_filename + '.tmp'
+        try:
+            f = open(temp_filename, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(temp_filename, self.catalog_filename)
+        except (IOError, OSError) as e:
+            logging.info("Unable to save file catalog %s: %s",
+                         self.catalog_filename, str(e))
+    def _rescan(self):
+        # Note, only new or modified files (as determined by their size
+        # and modification time) need their metadata extracted
+        dname = self.dirname
+        files = {}
+        pending = []
+        for fname in os.listdir(dname):
+            if fname.startswith('.'):
+                continue
+            try:
+                st = os.stat(os.path.join(dname, fname))
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            info = self.files.get(fname)
+            if (info is None or info[0] != st.st_size
+                or info[1] != st.st_mtime):
+                info = [st.st_size, st.st_mtime, None]
+            if info[2] is None:
+                pending.append(fname)
+            files[fname] = info
+        with self.lock:
+            self.files = files
+            self.pending = pending
+        self._start_scan()
+        return [(fname, files[fname][0])
+                for fname in sorted(files, key=str.lower)]
+    def _start_scan(self):
+        with self.lock:
+            if self.is_scanning or not self.pending:
+                return
+            self.is_scanning = True
+        bg_thread = threading.Thread(target=self._scan_thread)
+        bg_thread.daemon = True
+        bg_thread.start()
+    def _scan_thread(self):
+        # Extract metadata of pending files from a background thread
+        while 1:
+            with self.lock:
+                if not self.pending:
+                    self.is_scanning = False
+                    break
+                fname = self.pending.pop()
+                info = self.files.get(fname)
+            if info is None:
+                continue
+            try:
+                metadata = parse_metadata(os.path.join(self.dirname, fname))
+            except (IOError, OSError) as e:
+                logging.info("Unable to read metadata of %s: %s",
+                             fname, str(e))
+                metadata = {}
+            with self.lock:
+                if self.files.get(fname) is info:
+                    info[2] = metadata
+        self._save()
+    def get_file_list(self):
+        # Return a sorted list of (filename, size).  The directory
+        # modification time is not a reliable indication of changes
+        # (it has a coarse resolution on FAT filesystems and does not
+        # change when a file is modified in place) so every file is
+        # checked on each call.
+        return self._rescan()
+    def check_file(self, fname, size, mtime):
+        # Note a file that was modified since the last listing - its
+        # metadata is re-extracted
+        with self.lock:
+            info = self.files.get(fname)
+            if info is not None and info[0] == size and info[1] == mtime:
+                return
+            self.files[fname] = [size, mtime, None]
+            if fname not in self.pending:
+                self.pending.append(fname)
+        self._start_scan()
+    def get_metadata(self, fname):
+        with self.lock:
+            info = self.files.get(fname)
+            if info is None or info[2] is None:
+                return {}
+            return dict(info[2])
@@ -0,0 +1,59 @@
+# Support for profiling host reactor callbacks
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+class ReactorProfile:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.slow_threshold = config.getfloat('slow_threshold', .050,
+                                              above=0.)
+        self.report_count = config.getint('report_count', 10, minval=1)
+        self.profiler = None
+        if config.getboolean('enable', True):
+            self.profiler = self.reactor.set_profiler(self.slow_threshold)
+        # Register commands
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command("REACTOR_PROFILE",
+                                    self.cmd_REACTOR_PROFILE,
+                                    desc=self.cmd_REACTOR_PROFILE_help)
+    def stats(self, eventtime):
+        if self.profiler is None:
+            return False, ""
+        return False, self.profiler.stats(eventtime)
+    cmd_REACTOR_PROFILE_help = "Report or reset the reactor callback profile"
+    def cmd_REACTOR_PROFILE(self, params):
+        enable = self.gcode.get_int('ENABLE', params, None,
+                                    minval=0, maxval=1)
+        if enable is not None:
+            if enable:
+                self.profiler = self.reactor.set_profiler(self.slow_threshold)
+            else:
+                self.profiler = self.reactor.set_profiler(None)
+            self.gcode.respond_info("Reactor profiling %s" % (
+                ["disabled", "enabled"][enable],))
+            return
+        if self.profiler is None:
+            raise self.gcode.error("Reactor profiling is not enabled")
+        if self.gcode.get_int('RESET', params, 0, minval=0, maxval=1):
+            self.profiler.reset()
+            self.gcode.respond_info("Reactor profile reset")
+            return
+        count = self.gcode.get_int('COUNT', params, self.report_count,
+                                   minval=1)
+        msg = ["Slow callbacks (over %.3fs): %d" % (
+            self.slow_threshold, self.profiler.slow_count)]
+        if self.profiler.slow_name is not None:
+            msg.append("Slowest callback: %s (%.6fs)" % (
+                self.profiler.slow_name, self.profiler.slow_time))
+        msg.append("callback: count total max_time max_latency")
+        for name, count, total, max_time, max_latency in (
+                self.profiler.get_report()[:count]):
+            msg.append("%s: %d %.6f %.6f %.6f" % (
+                name, count, total, max_time, max_latency))
+        self.gcode.respond_info("\n".join(msg))
+
+def load_config(config):
+    return ReactorProfile(config)
@@ -100,8 +100,7 @@ class TMCCommandHelper:
             self.cmd_INIT_TMC, desc=self.cmd_INIT_TMC_help)
     def _init_registers(self, print_time=None):
         # Send registers
-        for reg_name, val in self.fields.registers.items():
-            self.mcu_tmc.set_register(reg_name, val, print_time)
+        self.mcu_tmc.set_registers(self.fields.registers.items(), print_time)
     def _handle_connect(self):
         # Check for soft stepper enable/disable
         stepper_enable = self.printer.lookup_object('stepper_enable')
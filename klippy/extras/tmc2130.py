@@ -199,6 +199,18 @@ class MCU_TMC_SPI:
                 (val >> 8) & 0xff, val & 0xff]
         with self.mutex:
             self.spi.spi_send(data, minclock)
+    def set_registers(self, reg_vals, print_time=None):
+        minclock = 0
+        if print_time is not None:
+            minclock = self.spi.get_mcu().print_time_to_clock(print_time)
+        data_list = []
+        for reg_name, val in reg_vals:
+            reg = self.name_to_reg[reg_name]
+            data_list.append([(reg | 0x80) & 0xff, (val >> 24) & 0xff,
+                              (val >> 16) & 0xff, (val >> 8) & 0xff,
+                              val & 0xff])
+        with self.mutex:
+            self.spi.spi_send_batch(data_list, minclock)
 
 
 ######################################################################
@@ -230,6 +230,17 @@ class MCU_TMC2660_SPI:
         msg = [((val >> 16) | reg) & 0xff, (val >> 8) & 0xff, val & 0xff]
         with self.mutex:
             self.spi.spi_send(msg, minclock)
+    def set_registers(self, reg_vals, print_time=None):
+        minclock = 0
+        if print_time is not None:
+            minclock = self.spi.get_mcu().print_time_to_clock(print_time)
+        msgs = []
+        for reg_name, val in reg_vals:
+            reg = self.name_to_reg[reg_name]
+            msgs.append([((val >> 16) | reg) & 0xff, (val >> 8) & 0xff,
+                         val & 0xff])
+        with self.mutex:
+            self.spi.spi_send_batch(msgs, minclock)
 
 
 ######################################################################
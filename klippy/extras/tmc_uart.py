@@ -227,3 +227,7 @@ class MCU_TMC_uart:
                     return
         raise self.printer.command_error(
             "Unable to write tmc uart '%s' register %s" % (self.name, reg_name))
+    def set_registers(self, reg_vals, print_time=None):
+        # Each uart write is verified, so they can not be batched
+        for reg_name, val in reg_vals:
+            self.set_register(reg_name, val, print_time)
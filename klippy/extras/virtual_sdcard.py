@@ -3,7 +3,127 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging
+import os, logging, threading, Queue
+import gcode_compile, gcode_index, gcode_metadata
+
+READ_CHUNK_SIZE = 65536
+
+# File reader that reads ahead from a background thread so that slow
+# storage does not stall the reactor
+class PrefetchFile:
+    def __init__(self, reactor, filename, max_chunks):
+        self.reactor = reactor
+        self.filename = filename
+        self.max_chunks = max_chunks
+        self.lock = threading.Lock()
+        self.waiter = None
+        self.chunks = self.stop_event = self.bg_thread = None
+        self.generation = 0
+        self.position = 0
+        self.is_eof = False
+        # Statistics
+        self.read_count = 0
+        self.max_read_time = self.wait_time = 0.
+    def _start(self):
+        # Each background thread is tagged with a generation so that
+        # completions from an old thread are ignored
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+        self.chunks = Queue.Queue(self.max_chunks)
+        self.stop_event = threading.Event()
+        self.bg_thread = threading.Thread(target=self._bg_thread, args=(
+            self.chunks, self.stop_event, generation, self.position))
+        self.bg_thread.daemon = True
+        self.bg_thread.start()
+    def stop(self):
+        # Stop the background thread (it is restarted on the next read)
+        if self.bg_thread is None:
+            return
+        with self.lock:
+            self.generation += 1
+            self.waiter = None
+        self.stop_event.set()
+        # Drain the queue so that a blocked put() in the thread returns
+        while 1:
+            try:
+                self.chunks.get_nowait()
+            except Queue.Empty:
+                break
+        self.bg_thread.join()
+        self.chunks = self.stop_event = self.bg_thread = None
+    def _bg_thread(self, chunks, stop_event, generation, position):
+        monotonic = self.reactor.monotonic
+        f = None
+        try:
+            f = open(self.filename, 'rb')
+            f.seek(position)
+            while not stop_event.is_set():
+                start_time = monotonic()
+                data = f.read(READ_CHUNK_SIZE)
+                read_time = monotonic() - start_time
+                with self.lock:
+                    self.read_count += 1
+                    self.max_read_time = max(self.max_read_time, read_time)
+                self._queue_chunk(chunks, stop_event, generation, data)
+                if not data:
+                    break
+        except:
+            logging.exception("virtual_sdcard read %s", self.filename)
+            self._queue_chunk(chunks, stop_event, generation, None)
+        finally:
+            if f is not None:
+                f.close()
+    def _queue_chunk(self, chunks, stop_event, generation, data):
+        if stop_event.is_set():
+            return
+        chunks.put(data)
+        with self.lock:
+            if generation != self.generation:
+                return
+            waiter = self.waiter
+            self.waiter = None
+        if waiter is not None:
+            self.reactor.async_complete(waiter, True)
+    def read(self, size=None):
+        # Note, the next available chunk is returned regardless of size
+        if self.is_eof:
+            return ""
+        if self.chunks is None:
+            self._start()
+        chunks = self.chunks
+        while 1:
+            try:
+                data = chunks.get_nowait()
+                break
+            except Queue.Empty:
+                pass
+            with self.lock:
+                if not chunks.empty():
+                    continue
+                self.waiter = completion = self.reactor.completion()
+            # Wait for background thread (recheck periodically as well)
+            start_time = self.reactor.monotonic()
+            completion.wait(start_time + 1.)
+            self.wait_time += self.reactor.monotonic() - start_time
+        if data is None:
+            self.is_eof = True
+            raise IOError("Unable to read %s" % (self.filename,))
+        if not data:
+            self.is_eof = True
+        self.position += len(data)
+        return data
+    def tell(self):
+        return self.position
+    def seek(self, position):
+        self.stop()
+        self.position = position
+        self.is_eof = False
+    def close(self):
+        self.stop()
+    def get_stats(self):
+        with self.lock:
+            return self.read_count, self.max_read_time, self.wait_time
 
 class VirtualSD:
     def __init__(self, config):
@@ -12,12 +132,22 @@ class VirtualSD:
         # sdcard state
         sd = config.get('path')
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
-        self.current_file = None
+        self.catalog = gcode_metadata.FileCatalog(self.sdcard_dirname)
+        self.read_ahead_chunks = config.getint('read_ahead_chunks', 4,
+                                               minval=1)
+        self.compiled_file = self.text_file = None
+        self.reader_file = None
+        self.current_filename = None
         self.file_position = self.file_size = 0
+        self.file_line = 0
+        self.file_index = self.index_pending = None
+        self.seek_script = None
+        self.partial_input = ""
         # Work timer
         self.reactor = printer.get_reactor()
         self.must_pause_work = self.cmd_from_sd = False
         self.work_timer = None
+        self.blocked_time = 0.
         # Register commands
         self.gcode = printer.lookup_object('gcode')
         self.gcode.register_command('M21', None)
@@ -25,14 +155,23 @@ class VirtualSD:
             self.gcode.register_command(cmd, getattr(self, 'cmd_' + cmd))
         for cmd in ['M28', 'M29', 'M30']:
             self.gcode.register_command(cmd, self.cmd_error)
+        self.gcode.register_command(
+            'SDCARD_PRINT_FILE', self.cmd_SDCARD_PRINT_FILE,
+            desc=self.cmd_SDCARD_PRINT_FILE_help)
+        self.gcode.register_command('SDCARD_SEEK', self.cmd_SDCARD_SEEK,
+                                    desc=self.cmd_SDCARD_SEEK_help)
     def handle_shutdown(self):
         if self.work_timer is not None:
             self.must_pause_work = True
             try:
                 readpos = max(self.file_position - 1024, 0)
                 readcount = self.file_position - readpos
-                self.current_file.seek(readpos)
-                data = self.current_file.read(readcount + 128)
+                f = open(self.current_filename, 'rb')
+                try:
+                    f.seek(readpos)
+                    data = f.read(readcount + 128)
+                finally:
+                    f.close()
             except:
                 logging.exception("virtual_sdcard shutdown read")
                 return
@@ -42,15 +181,16 @@ class VirtualSD:
     def stats(self, eventtime):
         if self.work_timer is None:
             return False, ""
-        return True, "sd_pos=%d" % (self.file_position,)
+        read_count = max_read_time = wait_time = 0.
+        if self.reader_file is not None:
+            read_count, max_read_time, wait_time = self.reader_file.get_stats()
+        return True, ("sd_pos=%d sd_reads=%d sd_read_max=%.6f sd_wait=%.3f"
+                      " sd_blocked=%.3f" % (
+                          self.file_position, read_count, max_read_time,
+                          wait_time, self.blocked_time))
     def get_file_list(self):
-        dname = self.sdcard_dirname
         try:
-            filenames = os.listdir(self.sdcard_dirname)
-            return [(fname, os.path.getsize(os.path.join(dname, fname)))
-                    for fname in sorted(filenames, key=str.lower)
-                    if not fname.startswith('.')
-                    and os.path.isfile((os.path.join(dname, fname)))]
+            return self.catalog.get_file_list()
         except:
             logging.exception("virtual_sdcard get_file_list")
             raise self.gcode.error("Unable to get file list")
@@ -58,7 +198,20 @@ class VirtualSD:
         progress = 0.
         if self.work_timer is not None and self.file_size:
             progress = float(self.file_position) / self.file_size
-        return {'progress': progress}
+        status = {'progress': progress, 'file_line': 0, 'file_lines': 0,
+                  'layer': 0, 'layer_count': 0, 'metadata': {}}
+        if self.current_filename is not None:
+            status['metadata'] = self.catalog.get_metadata(
+                os.path.basename(self.current_filename))
+        if self.work_timer is not None and self.file_line is not None:
+            status['file_line'] = self.file_line + 1
+        index = self.file_index
+        if index is not None:
+            status['file_lines'] = index.get_line_count()
+            status['layer_count'] = index.get_layer_count()
+            if self.work_timer is not None:
+                status['layer'] = index.find_layer(self.file_position)
+        return status
     def is_active(self):
         return self.work_timer is not None
     def do_pause(self):
@@ -83,10 +236,6 @@ class VirtualSD:
         # Select SD file
         if self.work_timer is not None:
             raise self.gcode.error("SD busy")
-        if self.current_file is not None:
-            self.current_file.close()
-            self.current_file = None
-            self.file_position = self.file_size = 0
         try:
             orig = params['#original']
             filename = orig[orig.find("M23") + 4:].split()[0].strip()
@@ -94,29 +243,49 @@ class VirtualSD:
                 filename = filename[:filename.find('*')].strip()
         except:
             raise self.gcode.error("Unable to extract filename")
+        self._load_file(filename)
+    def _lookup_file(self, filename):
         if filename.startswith('/'):
             filename = filename[1:]
         files = self.get_file_list()
         files_by_lower = { fname.lower(): fname for fname, fsize in files }
         try:
             fname = files_by_lower[filename.lower()]
-            fname = os.path.join(self.sdcard_dirname, fname)
-            f = open(fname, 'rb')
-            f.seek(0, os.SEEK_END)
-            fsize = f.tell()
-            f.seek(0)
+        except KeyError:
+            raise self.gcode.error("Unable to open file")
+        return os.path.join(self.sdcard_dirname, fname)
+    def _load_file(self, filename, index=None):
+        if self.current_filename is not None:
+            self._close_file()
+            self.file_position = self.file_size = 0
+        if filename.startswith('/'):
+            filename = filename[1:]
+        fname = self._lookup_file(filename)
+        try:
+            st = os.stat(fname)
+            fsize = st.st_size
         except:
             logging.exception("virtual_sdcard file open")
             raise self.gcode.error("Unable to open file")
+        self.catalog.check_file(os.path.basename(fname), fsize, st.st_mtime)
         self.gcode.respond("File opened:%s Size:%d" % (filename, fsize))
         self.gcode.respond("File selected")
-        self.current_file = f
-        self.file_position = 0
+        self.current_filename = fname
+        self.compiled_file = gcode_compile.open_compiled(
+            fname, self._open_prefetch)
+        self.file_position = self.file_line = 0
         self.file_size = fsize
+        self.seek_script = None
+        if index is not None:
+            self.file_index = index
+        else:
+            self._load_index(fname)
     def cmd_M24(self, params):
         # Start/resume SD print
         if self.work_timer is not None:
             raise self.gcode.error("SD busy")
+        self._start_work()
+    def _start_work(self):
         self.must_pause_work = False
         self.work_timer = self.reactor.register_timer(
             self.work_handler, self.reactor.NOW)
@@ -129,65 +298,227 @@ class VirtualSD:
             raise self.gcode.error("SD busy")
         pos = self.gcode.get_int('S', params, minval=0)
         self.file_position = pos
+        self.seek_script = None
+        # The line number is only known if the position is indexed
+        self.file_line = None
+        if not pos:
+            self.file_line = 0
+        elif self.file_index is not None:
+            try:
+                self.file_line = self.file_index.find_line(pos)
+            except (IOError, OSError):
+                logging.exception("virtual_sdcard find line")
     def cmd_M27(self, params):
         # Report SD print status
-        if self.current_file is None:
+        if self.current_filename is None:
             self.gcode.respond("Not SD printing.")
             return
         self.gcode.respond("SD printing byte %d/%d" % (
             self.file_position, self.file_size))
+    cmd_SDCARD_PRINT_FILE_help = "Load and start printing a file from the SD"
+    def cmd_SDCARD_PRINT_FILE(self, params):
+        if self.work_timer is not None:
+            raise self.gcode.error("SD busy")
+        filename = self.gcode.get_str('FILENAME', params)
+        layer = self.gcode.get_int('LAYER', params, None, minval=1)
+        index = None
+        if layer is not None:
+            # Validate the layer before the current file is replaced
+            fname = self._lookup_file(filename)
+            index = gcode_index.load_index(fname)
+            if index is None:
+                self._start_index_build(fname)
+                raise self.gcode.error("SD file index not yet available")
+            try:
+                index.get_layer(layer)
+            except gcode_index.error as e:
+                raise self.gcode.error(str(e))
+        self._load_file(filename, index)
+        if layer is not None:
+            self._seek_layer(layer)
+        self._start_work()
+    cmd_SDCARD_SEEK_help = "Set the SD print position to a layer or line"
+    def cmd_SDCARD_SEEK(self, params):
+        if self.work_timer is not None:
+            raise self.gcode.error("SD busy")
+        if self.current_filename is None:
+            raise self.gcode.error("No SD file selected")
+        if 'LAYER' in params:
+            self._seek_layer(self.gcode.get_int('LAYER', params, minval=1))
+        else:
+            line = self.gcode.get_int('LINE', params, minval=1)
+            index = self._get_index()
+            try:
+                self.file_position = index.find_line_offset(line - 1)
+            except gcode_index.error as e:
+                raise self.gcode.error(str(e))
+            except (IOError, OSError):
+                logging.exception("virtual_sdcard seek line")
+                raise self.gcode.error("Unable to read file")
+            self.file_line = line - 1
+            self.seek_script = None
+        self.gcode.respond_info("SD position set to byte %d" % (
+            self.file_position,))
+    # File index (line and layer offsets)
+    def _load_index(self, fname):
+        self.file_index = gcode_index.load_index(fname)
+        if self.file_index is None:
+            self._start_index_build(fname)
+    def _start_index_build(self, fname):
+        if self.index_pending == fname:
+            return
+        self.index_pending = fname
+        bg_thread = threading.Thread(target=self._build_index, args=(fname,))
+        bg_thread.daemon = True
+        bg_thread.start()
+    def _build_index(self, fname):
+        # Runs in a background thread
+        index = None
+        try:
+            index = gcode_index.build_index(fname)
+        except:
+            logging.exception("virtual_sdcard index %s", fname)
+        self.reactor.register_async_callback(
+            (lambda e: self._index_ready(fname, index)))
+    def _index_ready(self, fname, index):
+        if self.index_pending == fname:
+            self.index_pending = None
+        if index is not None and fname == self.current_filename:
+            logging.info("Built index of %s (%d lines, %d layers)", fname,
+                         index.get_line_count(), index.get_layer_count())
+            self.file_index = index
+    def _get_index(self):
+        if self.file_index is None:
+            raise self.gcode.error("SD file index not yet available")
+        return self.file_index
+    def _seek_layer(self, layer_num):
+        try:
+            layer = self._get_index().get_layer(layer_num)
+        except gcode_index.error as e:
+            raise self.gcode.error(str(e))
+        self.file_position = layer['offset']
+        self.file_line = layer['line']
+        # The g-code state in effect at the start of the layer is
+        # restored when the print is started
+        self.seek_script = "\n".join([
+            "G90" if layer['absolute_coord'] else "G91",
+            "M82" if layer['absolute_extrude'] else "M83",
+            "G92 E%.5f" % (layer['e_pos'],)])
+    def _close_file(self):
+        self.current_filename = None
+        self.file_index = None
+        self.seek_script = None
+        if self.compiled_file is not None:
+            self.compiled_file.close()
+            self.compiled_file = None
+        if self.text_file is not None:
+            self.text_file.close()
+            self.text_file = None
+        self.reader_file = None
+    def _open_prefetch(self, filename, mode='rb'):
+        return PrefetchFile(self.reactor, filename, self.read_ahead_chunks)
+    # File readers - each returns a list of (source_len, script, params)
+    # records and an empty list at EOF
+    def _read_text(self):
+        data = self.text_file.read(READ_CHUNK_SIZE)
+        if not data:
+            return []
+        lines = data.split('\n')
+        lines[0] = self.partial_input + lines[0]
+        self.partial_input = lines.pop()
+        return [(len(line) + 1, line, None) for line in lines]
+    def _read_compiled(self):
+        return self.compiled_file.read_commands()
+    def _start_reader(self):
+        self.partial_input = ""
+        if self.compiled_file is not None:
+            try:
+                if self.compiled_file.seek(self.file_position):
+                    self.reader_file = self.compiled_file.file
+                    return self._read_compiled
+            except:
+                logging.exception("virtual_sdcard compiled seek")
+            logging.info("Unable to use compiled file - using g-code text")
+            self.compiled_file.close()
+            self.compiled_file = None
+        if self.text_file is None:
+            self.text_file = self._open_prefetch(self.current_filename)
+        self.text_file.seek(self.file_position)
+        self.reader_file = self.text_file
+        return self._read_text
     # Background work timer
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
         try:
-            self.current_file.seek(self.file_position)
+            read_commands = self._start_reader()
         except:
             logging.exception("virtual_sdcard seek")
             self.gcode.respond_error("Unable to seek file")
             self.work_timer = None
             return self.reactor.NEVER
+        if self.seek_script is not None:
+            # Restore the g-code state of the seek position
+            self.cmd_from_sd = True
+            try:
+                self.gcode.run_script(self.seek_script)
+                self.seek_script = None
+            except self.gcode.error as e:
+                self.must_pause_work = True
+            except:
+                logging.exception("virtual_sdcard restore state")
+                self.must_pause_work = True
+            self.cmd_from_sd = False
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
         lines = []
+        line_pos = 0
         while not self.must_pause_work:
-            if not lines:
+            if line_pos >= len(lines):
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    lines = read_commands()
                 except:
                     logging.exception("virtual_sdcard read")
                     self.gcode.respond_error("Error on virtual sdcard read")
                     break
-                if not data:
+                line_pos = 0
+                if not lines:
                     # End of file
-                    self.current_file.close()
-                    self.current_file = None
+                    self._close_file()
                     logging.info("Finished SD card print")
                     self.gcode.respond("Done printing file")
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
                 self.reactor.pause(self.reactor.NOW)
                 continue
             # Pause if any other request is pending in the gcode class
             if gcode_mutex.test():
-                self.reactor.pause(self.reactor.monotonic() + 0.100)
+                # Resume as soon as the mutex is released (but recheck
+                # periodically so that a pause request is noticed)
+                start_time = self.reactor.monotonic()
+                gcode_mutex.wait(start_time + 0.100)
+                self.blocked_time += self.reactor.monotonic() - start_time
                 continue
             # Dispatch command
             self.cmd_from_sd = True
+            src_len, script, params = lines[line_pos]
             try:
-                self.gcode.run_script(lines[-1])
+                if params is not None:
+                    self.gcode.run_parsed_commands([params])
+                elif script is not None:
+                    self.gcode.run_script(script)
             except self.gcode.error as e:
                 break
             except:
                 logging.exception("virtual_sdcard dispatch")
                 break
             self.cmd_from_sd = False
-            self.file_position += len(lines.pop()) + 1
+            self.file_position += src_len
+            if self.file_line is not None:
+                self.file_line += 1
+            line_pos += 1
         logging.info("Exiting SD card print (position %d)", self.file_position)
+        if self.reader_file is not None:
+            self.reader_file.stop()
         self.work_timer = None
         self.cmd_from_sd = False
         return self.reactor.NEVER
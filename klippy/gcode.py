@@ -207,6 +207,34 @@ class GCodeParser:
         logging.info("\n".join(out))
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    def _parse_line(self, line):
+        # Break command into parts
+        parts = self.args_r.split(line.upper())[1:]
+        params = { parts[i]: parts[i+1].strip()
+                   for i in range(0, len(parts), 2) }
+        if parts and parts[0] == 'N':
+            # Skip line number at start of command
+            del parts[:2]
+        if not parts:
+            # Treat empty line as empty command
+            parts = ['', '']
+        params['#command'] = parts[0] + parts[1].strip()
+        return params
+    traditional_r = re.compile(r'^\s*(?:[A-Z][-+.0-9]*(?:\s+|$))*$')
+    def _parse_traditional_line(self, line):
+        # Fast path for lines made only of whitespace separated
+        # letter/number words (eg, "G1 X10 Y20.5 E.3") - returns None
+        # if the line needs the general parser
+        line = line.upper()
+        if self.traditional_r.match(line) is None:
+            return None
+        words = line.split()
+        params = { w[0]: w[1:] for w in words }
+        if words and words[0][0] == 'N':
+            # Skip line number at start of command
+            del words[0]
+        params['#command'] = words[0] if words else ''
+        return params
     def _process_commands(self, commands, need_ack=True):
         for line in commands:
             # Ignore comments and leading/trailing spaces
@@ -214,36 +242,31 @@ class GCodeParser:
             cpos = line.find(';')
             if cpos >= 0:
                 line = line[:cpos]
-            # Break command into parts
-            parts = self.args_r.split(line.upper())[1:]
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(0, len(parts), 2) }
+            params = self._parse_traditional_line(line)
+            if params is None:
+                params = self._parse_line(line)
             params['#original'] = origline
-            if parts and parts[0] == 'N':
-                # Skip line number at start of command
-                del parts[:2]
-            if not parts:
-                # Treat empty line as empty command
-                parts = ['', '']
-            params['#command'] = cmd = parts[0] + parts[1].strip()
-            # Invoke handler for command
-            self.need_ack = need_ack
-            handler = self.gcode_handlers.get(cmd, self.cmd_default)
-            try:
-                handler(params)
-            except self.error as e:
-                self.respond_error(str(e))
-                self.reset_last_position()
-                if not need_ack:
-                    raise
-            except:
-                msg = 'Internal error on command:"%s"' % (cmd,)
-                logging.exception(msg)
-                self.printer.invoke_shutdown(msg)
-                self.respond_error(msg)
-                if not need_ack:
-                    raise
-            self.ack()
+            self._process_params(params, need_ack)
+    def _process_params(self, params, need_ack):
+        cmd = params['#command']
+        # Invoke handler for command
+        self.need_ack = need_ack
+        handler = self.gcode_handlers.get(cmd, self.cmd_default)
+        try:
+            handler(params)
+        except self.error as e:
+            self.respond_error(str(e))
+            self.reset_last_position()
+            if not need_ack:
+                raise
+        except:
+            msg = 'Internal error on command:"%s"' % (cmd,)
+            logging.exception(msg)
+            self.printer.invoke_shutdown(msg)
+            self.respond_error(msg)
+            if not need_ack:
+                raise
+        self.ack()
     m112_r = re.compile('^(?:[nN][0-9]+)?\s*[mM]112(?:\s|$)')
     def _process_data(self, eventtime):
         # Read input, separate by newline, and add to pending_commands
@@ -299,6 +322,11 @@ class GCodeParser:
     def run_script(self, script):
         with self.mutex:
             self._process_commands(script.split('\n'), need_ack=False)
+    def run_parsed_commands(self, commands):
+        # Run commands that were already parsed into params dictionaries
+        with self.mutex:
+            for params in commands:
+                self._process_params(params, need_ack=False)
     def get_mutex(self):
         return self.mutex
     # Response handling
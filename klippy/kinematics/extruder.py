@@ -48,7 +48,8 @@ class PrinterExtruder:
         # Setup iterative solver
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
-        self.trapq_append = ffi_lib.trapq_append
+        self.trapq_append_batch = ffi_lib.trapq_append_batch
+        self.trapq_moves = []
         self.trapq_free_moves = ffi_lib.trapq_free_moves
         self.sk_extruder = ffi_main.gc(ffi_lib.extruder_stepper_alloc(),
                                        ffi_lib.free)
@@ -140,11 +141,19 @@ class PrinterExtruder:
         if axis_r > 0. and (move.axes_d[0] or move.axes_d[1]):
             pressure_advance = self.pressure_advance
         # Queue movement (x is extruder movement, y is pressure advance)
-        self.trapq_append(self.trapq, print_time,
-                          move.accel_t, move.cruise_t, move.decel_t,
-                          move.start_pos[3], 0., 0.,
-                          1., pressure_advance, 0.,
-                          start_v, cruise_v, accel)
+        self.trapq_moves.extend((print_time,
+                                 move.accel_t, move.cruise_t, move.decel_t,
+                                 move.start_pos[3], 0., 0.,
+                                 1., pressure_advance, 0.,
+                                 start_v, cruise_v, accel))
+    def submit_moves(self):
+        # Add the moves queued by move() to the trapq
+        trapq_moves = self.trapq_moves
+        if trapq_moves:
+            self.trapq_moves = []
+            self.trapq_append_batch(
+                self.trapq, trapq_moves,
+                len(trapq_moves) // chelper.TRAPQ_APPEND_SIZE)
     def cmd_M104(self, params, wait=False):
         # Set Extruder Temperature
         gcode = self.printer.lookup_object('gcode')
@@ -201,6 +210,8 @@ class PrinterExtruder:
 class DummyExtruder:
     def update_move_time(self, flush_time):
         pass
+    def submit_moves(self):
+        pass
     def check_move(self, move):
         raise homing.EndstopMoveError(
             move.end_pos, "Extrude when no extruder present")
@@ -321,6 +321,12 @@ class CommandWrapper:
     def send(self, data=(), minclock=0, reqclock=0):
         cmd = self._cmd.encode(data)
         self._serial.raw_send(cmd, minclock, reqclock, self._cmd_queue)
+    def encode(self, data=()):
+        return self._cmd.encode(data)
+    def send_batch(self, cmds, minclock=0, reqclock=0):
+        # Transmit a list of messages (as created by encode() on this
+        # command or any other command using the same command queue)
+        self._serial.raw_send_batch(cmds, minclock, reqclock, self._cmd_queue)
     def send_with_response(self, data=(), response=None, response_oid=None,
                            minclock=0):
         minsystime = 0.
@@ -353,10 +359,14 @@ class MCU:
         self._serialport = config.get('serial', '/dev/ttyS0')
         baud = 0
         if not (self._serialport.startswith("/dev/rpmsg_")
-                or self._serialport.startswith("/tmp/klipper_host_")):
+                or self._serialport.startswith("/tmp/klipper_host_")
+                or serialhdl.is_socket_port(self._serialport)):
             baud = config.getint('baud', 250000, minval=2400)
+        identify_cache = config.get('identify_cache', None)
+        if identify_cache is not None:
+            identify_cache = os.path.expanduser(identify_cache)
         self._serial = serialhdl.SerialReader(
-            self._reactor, self._serialport, baud)
+            self._reactor, self._serialport, baud, identify_cache)
         # Restarts
         self._restart_method = 'command'
         if baud:
@@ -377,7 +387,7 @@ class MCU:
         self._custom = config.get('custom', '')
         self._mcu_freq = 0.
         # Move command queuing
-        ffi_main, self._ffi_lib = chelper.get_ffi()
+        self._ffi_main, self._ffi_lib = chelper.get_ffi()
         self._max_stepper_error = config.getfloat(
             'max_stepper_error', 0.000025, minval=0.)
         self._stepqueues = []
@@ -472,14 +482,12 @@ class MCU:
         if prev_crc is None:
             logging.info("Sending MCU '%s' printer configuration...",
                          self._name)
-            for c in self._config_cmds:
-                self._serial.send(c)
+            self._serial.send_batch(self._config_cmds)
         elif config_crc != prev_crc:
             self._check_restart("CRC mismatch")
             raise error("MCU '%s' CRC does not match config" % (self._name,))
         # Transmit init messages
-        for c in self._init_cmds:
-            self._serial.send(c)
+        self._serial.send_batch(self._init_cmds)
     def _send_get_config(self):
         get_config_cmd = self.lookup_command("get_config")
         if self.is_fileoutput():
@@ -702,12 +710,28 @@ class MCU:
                      self._name, eventtime)
         self._printer.invoke_shutdown("Lost communication with MCU '%s'" % (
             self._name,))
+    def _stepcompress_stats(self):
+        steps = queue_steps = 0
+        compress_time = 0.
+        stats = self._ffi_main.new('struct stepcompress_stats *')
+        for stepqueue in self._stepqueues:
+            self._ffi_lib.stepcompress_get_stats(stepqueue, stats)
+            steps += stats.step_count
+            queue_steps += stats.queue_step_count
+            compress_time += stats.compress_time
+        return "step_compress_ratio=%.2f step_compress_time=%.3f" % (
+            float(steps) / max(1, queue_steps), compress_time)
     def stats(self, eventtime):
         msg = "%s: mcu_awake=%.03f mcu_task_avg=%.06f mcu_task_stddev=%.06f" % (
             self._name, self._mcu_tick_awake, self._mcu_tick_avg,
             self._mcu_tick_stddev)
-        return False, ' '.join([msg, self._serial.stats(eventtime),
-                                self._clocksync.stats(eventtime)])
+        parts = [msg, self._serial.stats(eventtime),
+                 self._clocksync.stats(eventtime)]
+        if self._stepqueues:
+            parts.append(self._stepcompress_stats())
+        return False, ' '.join(parts)
+    def get_status(self, eventtime):
+        return {'clock_sync': self._clocksync.get_status(eventtime)}
     def __del__(self):
         self._disconnect()
 
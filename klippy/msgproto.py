@@ -26,13 +26,18 @@ MESSAGE_SYNC = '\x7E'
 class error(Exception):
     pass
 
+def _crc16_ccitt_byte(crc, data):
+    data ^= crc & 0xff
+    data ^= (data & 0x0f) << 4
+    return (((data << 8) | (crc >> 8)) ^ (data >> 4) ^ (data << 3)) & 0xffff
+
+CRC16_TABLE = [_crc16_ccitt_byte(0, i) for i in range(256)]
+
 def crc16_ccitt(buf):
     crc = 0xffff
-    for data in buf:
-        data = ord(data)
-        data ^= crc & 0xff
-        data ^= (data & 0x0f) << 4
-        crc = ((data << 8) | (crc >> 8)) ^ (data >> 4) ^ (data << 3)
+    table = CRC16_TABLE
+    for data in bytearray(buf):
+        crc = (crc >> 8) ^ table[(crc ^ data) & 0xff]
     crc = chr(crc >> 8) + chr(crc & 0xff)
     return crc
 
@@ -128,6 +133,34 @@ def lookup_params(msgformat, enumerations={}):
         out.append((name, pt))
     return out
 
+# Build a function that decodes all the parameters of a message.  The
+# integer types are decoded inline to avoid a method call per field.
+def compile_parser(param_names):
+    code = ["def parse(s, pos):", "    pos += 1", "    out = {}"]
+    parsers = []
+    for name, t in param_names:
+        if not isinstance(t, PT_uint32):
+            code.append("    out[%s], pos = parsers[%d](s, pos)" % (
+                repr(name), len(parsers)))
+            parsers.append(t.parse)
+            continue
+        code.extend(["    c = s[pos]",
+                     "    pos += 1",
+                     "    v = c & 0x7f",
+                     "    if (c & 0x60) == 0x60:",
+                     "        v |= -0x20",
+                     "    while c & 0x80:",
+                     "        c = s[pos]",
+                     "        pos += 1",
+                     "        v = (v<<7) | (c & 0x7f)"])
+        if not t.signed:
+            code.append("    v = int(v & 0xffffffff)")
+        code.append("    out[%s] = v" % (repr(name),))
+    code.append("    return out, pos")
+    env = {'parsers': parsers}
+    exec '\n'.join(code) in env
+    return env['parse']
+
 # Update the message format to be compatible with python's % operator
 def convert_msg_format(msgformat):
     for c in ['%u', '%i', '%hu', '%hi', '%c', '%.*s', '%*s']:
@@ -143,6 +176,7 @@ class MessageFormat:
         self.param_names = lookup_params(msgformat, enumerations)
         self.param_types = [t for name, t in self.param_names]
         self.name_to_type = dict(self.param_names)
+        self.parse = compile_parser(self.param_names)
     def encode(self, params):
         out = []
         out.append(self.msgid)
@@ -155,13 +189,6 @@ class MessageFormat:
         for name, t in self.param_names:
             t.encode(out, params[name])
         return out
-    def parse(self, s, pos):
-        pos += 1
-        out = {}
-        for name, t in self.param_names:
-            v, pos = t.parse(s, pos)
-            out[name] = v
-        return out, pos
     def format_params(self, params):
         out = []
         for name, t in self.param_names:
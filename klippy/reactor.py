@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, select, math, time, Queue
+import os, select, math, time, heapq, logging, Queue
 import greenlet
 import chelper, util
 
@@ -14,6 +14,7 @@ class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        self.entry = None
 
 class ReactorCompletion:
     class sentinel: pass
@@ -66,10 +67,20 @@ class ReactorMutex:
         self.is_locked = is_locked
         self.next_pending = False
         self.queue = []
+        self.waiters = []
         self.lock = self.__enter__
         self.unlock = self.__exit__
     def test(self):
         return self.is_locked
+    def wait(self, waketime=_NEVER):
+        # Wait (without taking the lock) until the mutex is unlocked
+        if not self.is_locked:
+            return True
+        completion = ReactorCompletion(self.reactor)
+        self.waiters.append(completion)
+        if completion.wait(waketime) is None:
+            self.waiters.remove(completion)
+        return not self.is_locked
     def __enter__(self):
         if not self.is_locked:
             self.is_locked = True
@@ -85,10 +96,83 @@ class ReactorMutex:
     def __exit__(self, type=None, value=None, tb=None):
         if not self.queue:
             self.is_locked = False
+            waiters = self.waiters
+            if waiters:
+                self.waiters = []
+                for completion in waiters:
+                    completion.complete(True)
             return
         self.next_pending = True
         self.reactor.update_timer(self.queue[0].timer, self.reactor.NOW)
 
+def _get_callback_name(callback):
+    obj = getattr(callback, '__self__', None)
+    if isinstance(obj, ReactorCallback):
+        return _get_callback_name(obj.callback)
+    if isinstance(obj, greenlet.greenlet) and obj.gr_frame is not None:
+        # Resuming a paused greenlet - report the code that paused
+        frame = obj.gr_frame
+        while (frame.f_back is not None
+               and frame.f_globals.get('__name__') == __name__):
+            frame = frame.f_back
+        return "<resume %s:%s>" % (os.path.basename(frame.f_code.co_filename),
+                                   frame.f_code.co_name)
+    code = getattr(callback, 'func_code', None)
+    if code is not None and callback.__name__ == '<lambda>':
+        return "<lambda %s:%d>" % (
+            os.path.basename(code.co_filename), code.co_firstlineno)
+    name = getattr(callback, '__name__', None) or repr(callback)
+    if obj is not None:
+        name = "%s.%s" % (obj.__class__.__name__, name)
+    return name
+
+# Timing of timer and fd callbacks (enabled via set_profiler())
+class ReactorProfiler:
+    def __init__(self, reactor, slow_threshold):
+        self.reactor = reactor
+        self.slow_threshold = slow_threshold
+        self.reset()
+    def reset(self):
+        # callbacks[name] = [count, total_time, max_time, max_latency]
+        self.callbacks = {}
+        self.slow_count = 0
+        self.slow_name = None
+        self.slow_time = 0.
+    def run(self, callback, eventtime, waketime=_NOW):
+        reactor = self.reactor
+        g_dispatch = reactor._g_dispatch
+        name = _get_callback_name(callback)
+        start_time = reactor.monotonic()
+        res = callback(eventtime)
+        if g_dispatch is not reactor._g_dispatch:
+            # Callback paused - its run time includes other callbacks
+            return res
+        run_time = reactor.monotonic() - start_time
+        info = self.callbacks.get(name)
+        if info is None:
+            info = self.callbacks[name] = [0, 0., 0., 0.]
+        info[0] += 1
+        info[1] += run_time
+        if run_time > info[2]:
+            info[2] = run_time
+        if waketime > _NOW and start_time - waketime > info[3]:
+            info[3] = start_time - waketime
+        if run_time > self.slow_threshold:
+            self.slow_count += 1
+            if run_time > self.slow_time:
+                self.slow_name, self.slow_time = name, run_time
+            logging.warning("Slow reactor callback %s: %.6f seconds",
+                            name, run_time)
+        return res
+    def get_report(self):
+        # Return list of (name, count, total, max_time, max_latency)
+        return sorted([(name,) + tuple(info)
+                       for name, info in self.callbacks.items()],
+                      key=(lambda i: i[2]), reverse=True)
+    def stats(self, eventtime):
+        return "reactor_slow=%d reactor_slow_max=%.6f" % (
+            self.slow_count, self.slow_time)
+
 class SelectReactor:
     NOW = _NOW
     NEVER = _NEVER
@@ -96,8 +180,9 @@ class SelectReactor:
         # Main code
         self._process = False
         self.monotonic = chelper.get_ffi()[1].get_monotonic
-        # Timers
-        self._timers = []
+        # Timers (heap of [waketime, sequence, timer] entries)
+        self._timer_heap = []
+        self._timer_count = self._timer_seq = 0
         self._next_timer = self.NEVER
         # Callbacks
         self._pipe_fds = None
@@ -107,40 +192,91 @@ class SelectReactor:
         # Greenlets
         self._g_dispatch = None
         self._greenlets = []
+        # Profiling
+        self._profiler = None
     # Timers
-    def update_timer(self, timer_handler, waketime):
+    def _schedule_timer(self, timer_handler, waketime):
+        # Replace the timer's heap entry (old entries are left in the
+        # heap, but marked as invalid, until they are popped)
         timer_handler.waketime = waketime
-        self._next_timer = min(self._next_timer, waketime)
+        if timer_handler.entry is not None:
+            timer_handler.entry[2] = None
+        self._timer_seq += 1
+        entry = [waketime, self._timer_seq, timer_handler]
+        timer_handler.entry = entry
+        heap = self._timer_heap
+        heapq.heappush(heap, entry)
+        if len(heap) > 2 * self._timer_count + 32:
+            heap[:] = [e for e in heap if e[2] is not None]
+            heapq.heapify(heap)
+        if waketime < self._next_timer:
+            self._next_timer = waketime
+    def update_timer(self, timer_handler, waketime):
+        if timer_handler.entry is None:
+            # Timer not registered
+            timer_handler.waketime = waketime
+            return
+        self._schedule_timer(timer_handler, waketime)
     def register_timer(self, callback, waketime=NEVER):
         timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
-        self._next_timer = min(self._next_timer, waketime)
+        self._timer_count += 1
+        self._schedule_timer(timer_handler, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
+        if timer_handler.entry is not None:
+            timer_handler.entry[2] = None
+            timer_handler.entry = None
+            self._timer_count -= 1
     def _check_timers(self, eventtime):
         if eventtime < self._next_timer:
             return min(1., max(.001, self._next_timer - eventtime))
-        self._next_timer = self.NEVER
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            waketime = t.waketime
-            if eventtime >= waketime:
-                t.waketime = self.NEVER
-                t.waketime = waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._next_timer = min(self._next_timer, waketime)
-        if eventtime >= self._next_timer:
+        heap = self._timer_heap
+        # Run the ready timers one at a time (so that the heap holds all
+        # other timers should a callback pause).  Timers scheduled during
+        # this pass are not run again until the next call.
+        seq_limit = self._timer_seq
+        profiler = self._profiler
+        while heap:
+            entry = heap[0]
+            if entry[0] > eventtime or entry[1] > seq_limit:
+                break
+            heapq.heappop(heap)
+            t = entry[2]
+            if t is None:
+                # Timer updated or removed
+                continue
+            t.waketime = _NEVER
+            if profiler is None:
+                waketime = t.callback(eventtime)
+            else:
+                waketime = profiler.run(t.callback, eventtime, entry[0])
+            if t.entry is entry:
+                # Reuse the popped entry (a timer that is to run again
+                # immediately is ordered after the other ready timers)
+                t.waketime = entry[0] = waketime
+                if waketime < eventtime:
+                    entry[0] = eventtime
+                self._timer_seq = entry[1] = self._timer_seq + 1
+                heapq.heappush(heap, entry)
+            elif t.entry is not None:
+                self._schedule_timer(t, waketime)
+            else:
+                t.waketime = waketime
+            if g_dispatch is not self._g_dispatch:
+                self._next_timer = self.NOW
+                self._end_greenlet(g_dispatch)
+                return 0.
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        next_timer = self.NEVER
+        if heap:
+            next_timer = heap[0][0]
+        self._next_timer = next_timer
+        if eventtime >= next_timer:
             return 0.
-        return min(1., max(.001, self._next_timer - self.monotonic()))
+        return min(1., max(.001, next_timer - self.monotonic()))
     # Callbacks and Completions
     def completion(self):
         return ReactorCompletion(self)
@@ -220,6 +356,17 @@ class SelectReactor:
     # Mutexes
     def mutex(self, is_locked=False):
         return ReactorMutex(self, is_locked)
+    # Profiling
+    def set_profiler(self, slow_threshold=None):
+        # Enable callback profiling (or disable it if slow_threshold
+        # is None)
+        if slow_threshold is None:
+            self._profiler = None
+        else:
+            self._profiler = ReactorProfiler(self, slow_threshold)
+        return self._profiler
+    def get_profiler(self):
+        return self._profiler
     # File descriptors
     def register_fd(self, fd, callback):
         file_handler = ReactorFileHandler(fd, callback)
@@ -236,7 +383,10 @@ class SelectReactor:
             res = select.select(self._fds, [], [], timeout)
             eventtime = self.monotonic()
             for fd in res[0]:
-                fd.callback(eventtime)
+                if self._profiler is None:
+                    fd.callback(eventtime)
+                else:
+                    self._profiler.run(fd.callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -278,7 +428,10 @@ class PollReactor(SelectReactor):
             res = self._poll.poll(int(math.ceil(timeout * 1000.)))
             eventtime = self.monotonic()
             for fd, event in res:
-                self._fds[fd](eventtime)
+                if self._profiler is None:
+                    self._fds[fd](eventtime)
+                else:
+                    self._profiler.run(self._fds[fd], eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -312,7 +465,10 @@ class EPollReactor(SelectReactor):
             res = self._epoll.poll(timeout)
             eventtime = self.monotonic()
             for fd, event in res:
-                self._fds[fd](eventtime)
+                if self._profiler is None:
+                    self._fds[fd](eventtime)
+                else:
+                    self._profiler.run(self._fds[fd], eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading
+import logging, threading, os, zlib, socket
 import serial
 
 import msgproto, chelper, util
@@ -13,10 +13,13 @@ class error(Exception):
 
 class SerialReader:
     BITS_PER_BYTE = 10.
-    def __init__(self, reactor, serialport, baud):
+    PULL_BATCH = 32
+    IDENTIFY_CHECK_SIZE = 20
+    def __init__(self, reactor, serialport, baud, identify_cache=None):
         self.reactor = reactor
         self.serialport = serialport
         self.baud = baud
+        self.identify_cache = identify_cache
         # Serial port
         self.ser = None
         self.msgparser = msgproto.MessageParser()
@@ -30,25 +33,43 @@ class SerialReader:
         self.background_thread = None
         # Message handlers
         self.handlers = {}
+        self.pull_count = self.pull_msgs = self.pull_max = 0
+        self.handler_latency = self.handler_latency_max = 0.
         self.register_response(self._handle_unknown_init, '#unknown')
         self.register_response(self.handle_output, '#output')
     def _bg_thread(self):
-        response = self.ffi_main.new('struct pull_queue_message *')
+        responses = self.ffi_main.new('struct pull_queue_message[%d]' % (
+            self.PULL_BATCH,))
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
+            count = self.ffi_lib.serialqueue_pull_multiple(
+                self.serialqueue, responses, len(responses))
             if count <= 0:
                 break
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
-            try:
-                with self.lock:
-                    hdl = self.handlers.get(hdl, self.handle_default)
-                    hdl(params)
-            except:
-                logging.exception("Exception in serial callback")
+            # Parse all the received messages
+            msgs = []
+            for i in range(count):
+                response = responses[i]
+                params = self.msgparser.parse(response.msg[0:response.len])
+                params['#sent_time'] = response.sent_time
+                params['#receive_time'] = response.receive_time
+                msgs.append(params)
+            # Dispatch them to their handlers
+            with self.lock:
+                for params in msgs:
+                    hdl = (params['#name'], params.get('oid'))
+                    try:
+                        hdl = self.handlers.get(hdl, self.handle_default)
+                        hdl(params)
+                    except:
+                        logging.exception("Exception in serial callback")
+            # Update statistics (latency is from the receipt of the
+            # oldest message in the batch until all handlers complete)
+            latency = self.ffi_lib.get_monotonic() - msgs[0]['#receive_time']
+            self.pull_count += 1
+            self.pull_msgs += count
+            self.pull_max = max(self.pull_max, count)
+            self.handler_latency += latency
+            self.handler_latency_max = max(self.handler_latency_max, latency)
     def _get_identify_data(self, timeout):
         # Query the "data dictionary" from the micro-controller
         identify_data = ""
@@ -63,6 +84,50 @@ class SerialReader:
                 identify_data += msgdata
             if self.reactor.monotonic() > timeout:
                 raise error("Timeout during identify")
+    def _get_cached_identify_data(self):
+        # Load a previously downloaded "data dictionary" and check that
+        # the micro-controller still reports the same one.  The data is
+        # zlib compressed, so its last bytes contain a checksum of the
+        # dictionary contents.
+        try:
+            f = open(self.identify_cache, 'rb')
+            identify_data = f.read()
+            f.close()
+            zlib.decompress(identify_data)
+        except (IOError, OSError, zlib.error) as e:
+            logging.debug("Unable to load identify cache: %s", e)
+            return None
+        offset = len(identify_data) - self.IDENTIFY_CHECK_SIZE
+        if offset < 0:
+            return None
+        msg = "identify offset=%d count=%d" % (offset, 40)
+        params = self.send_with_response(msg, 'identify_response')
+        if (params['offset'] != offset
+            or params['data'] != identify_data[offset:]):
+            logging.info("Identify cache does not match mcu")
+            return None
+        logging.info("Loaded identify data from cache %s",
+                     self.identify_cache)
+        return identify_data
+    def _update_identify_cache(self, identify_data):
+        try:
+            temp_name = self.identify_cache + ".tmp"
+            f = open(temp_name, 'wb')
+            f.write(identify_data)
+            f.close()
+            os.rename(temp_name, self.identify_cache)
+        except (IOError, OSError) as e:
+            logging.warn("Unable to write identify cache: %s", e)
+    def _open_socket(self):
+        # Connect to a tcp ("tcp:host:port") or unix ("unix:path") socket
+        if self.serialport.startswith('tcp:'):
+            host, port = self.serialport[4:].rsplit(':', 1)
+            sock = socket.create_connection((host, int(port)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.serialport[5:])
+        return sock
     def connect(self):
         # Initial connection
         logging.info("Starting serial connect")
@@ -72,7 +137,9 @@ class SerialReader:
             if connect_time > start_time + 150.:
                 raise error("Unable to connect")
             try:
-                if self.baud:
+                if is_socket_port(self.serialport):
+                    self.ser = self._open_socket()
+                elif self.baud:
                     self.ser = serial.Serial(
                         self.serialport, self.baud, timeout=0, exclusive=True)
                 else:
@@ -89,7 +156,13 @@ class SerialReader:
             self.background_thread.start()
             # Obtain and load the data dictionary from the firmware
             try:
-                identify_data = self._get_identify_data(connect_time + 5.)
+                identify_data = None
+                if self.identify_cache is not None:
+                    identify_data = self._get_cached_identify_data()
+                if identify_data is None:
+                    identify_data = self._get_identify_data(connect_time + 5.)
+                    if self.identify_cache is not None:
+                        self._update_identify_cache(identify_data)
             except error as e:
                 logging.exception("Timeout on serial connect")
                 self.disconnect()
@@ -131,7 +204,14 @@ class SerialReader:
             return ""
         self.ffi_lib.serialqueue_get_stats(
             self.serialqueue, self.stats_buf, len(self.stats_buf))
-        return self.ffi_main.string(self.stats_buf)
+        stats = self.ffi_main.string(self.stats_buf)
+        if not self.pull_count:
+            return stats
+        return ("%s receive_batch=%.2f receive_batch_max=%d"
+                " handler_latency=%.6f handler_latency_max=%.6f" % (
+                    stats, float(self.pull_msgs) / self.pull_count,
+                    self.pull_max, self.handler_latency / self.pull_count,
+                    self.handler_latency_max))
     def get_msgparser(self):
         return self.msgparser
     def get_default_command_queue(self):
@@ -147,9 +227,20 @@ class SerialReader:
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
         self.ffi_lib.serialqueue_send(
             self.serialqueue, cmd_queue, cmd, len(cmd), minclock, reqclock)
+    def raw_send_batch(self, cmds, minclock, reqclock, cmd_queue):
+        if not cmds:
+            return
+        data = [b for cmd in cmds for b in cmd]
+        lens = [len(cmd) for cmd in cmds]
+        self.ffi_lib.serialqueue_send_multiple(
+            self.serialqueue, cmd_queue, data, lens, len(cmds),
+            minclock, reqclock)
     def send(self, msg, minclock=0, reqclock=0):
         cmd = self.msgparser.create_command(msg)
         self.raw_send(cmd, minclock, reqclock, self.default_cmd_queue)
+    def send_batch(self, msgs, minclock=0, reqclock=0):
+        cmds = [self.msgparser.create_command(msg) for msg in msgs]
+        self.raw_send_batch(cmds, minclock, reqclock, self.default_cmd_queue)
     def send_with_response(self, msg, response):
         cmd = self.msgparser.create_command(msg)
         src = SerialRetryCommand(self, response)
@@ -195,6 +286,10 @@ class SerialReader:
     def __del__(self):
         self.disconnect()
 
+# Check if the given port name refers to a tcp or unix socket
+def is_socket_port(serialport):
+    return serialport.startswith('tcp:') or serialport.startswith('unix:')
+
 # Class to retry sending of a query command until a given response is received
 class SerialRetryCommand:
     TIMEOUT_TIME = 5.0
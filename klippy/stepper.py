@@ -150,7 +150,7 @@ class MCU_stepper:
         return old_tq
     def add_active_callback(self, cb):
         self._active_callbacks.append(cb)
-    def generate_steps(self, flush_time):
+    def generate_steps(self, flush_time, pending_callbacks=None):
         # Check for activity if necessary
         if self._active_callbacks:
             ret = self._itersolve_check_active(self._stepper_kinematics,
@@ -158,8 +158,12 @@ class MCU_stepper:
             if ret:
                 cbs = self._active_callbacks
                 self._active_callbacks = []
-                for cb in cbs:
-                    cb(ret)
+                if pending_callbacks is not None:
+                    # Caller will invoke the callbacks from the main thread
+                    pending_callbacks.extend([(cb, ret) for cb in cbs])
+                else:
+                    for cb in cbs:
+                        cb(ret)
         # Generate steps
         ret = self._itersolve_generate_steps(self._stepper_kinematics,
                                              flush_time)
@@ -282,9 +286,9 @@ class PrinterRail:
     def setup_itersolve(self, alloc_func, *params):
         for stepper in self.steppers:
             stepper.setup_itersolve(alloc_func, *params)
-    def generate_steps(self, flush_time):
+    def generate_steps(self, flush_time, pending_callbacks=None):
         for stepper in self.steppers:
-            stepper.generate_steps(flush_time)
+            stepper.generate_steps(flush_time, pending_callbacks)
     def set_trapq(self, trapq):
         for stepper in self.steppers:
             stepper.set_trapq(trapq)
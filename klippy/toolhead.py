@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging, importlib
+import math, logging, importlib, threading, Queue
 import mcu, homing, chelper, kinematics.extruder
 
 # Common suffixes: _d is distance (in mm), _v is velocity (in
@@ -11,17 +11,35 @@ import mcu, homing, chelper, kinematics.extruder
 #   seconds), _r is ratio (scalar between 0.0 and 1.0)
 
 # Class to track each move request
-class Move:
+class Move(object):
+    __slots__ = [
+        'toolhead', 'start_pos', 'end_pos', 'accel', 'timing_callbacks',
+        'is_kinematic_move', 'axes_d', 'move_d', 'axes_r', 'min_move_t',
+        'max_start_v2', 'max_cruise_v2', 'delta_v2', 'max_smoothed_v2',
+        'smooth_delta_v2', 'start_v', 'cruise_v', 'end_v',
+        'accel_t', 'cruise_t', 'decel_t', 'checked_smoothed_v2']
     def __init__(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
+        self.timing_callbacks = []
+        self.axes_d = [0., 0., 0., 0.]
+        self.axes_r = [0., 0., 0., 0.]
+        self.setup(start_pos, end_pos, speed)
+    def setup(self, start_pos, end_pos, speed):
+        # Initialize the move (moves are reused after being processed)
+        toolhead = self.toolhead
         self.start_pos = tuple(start_pos)
         self.end_pos = tuple(end_pos)
         self.accel = toolhead.max_accel
-        self.timing_callbacks = []
         velocity = min(speed, toolhead.max_velocity)
         self.is_kinematic_move = True
-        self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+        axes_d = self.axes_d
+        axes_d[0] = end_pos[0] - start_pos[0]
+        axes_d[1] = end_pos[1] - start_pos[1]
+        axes_d[2] = end_pos[2] - start_pos[2]
+        axes_d[3] = end_pos[3] - start_pos[3]
+        self.move_d = move_d = math.sqrt(axes_d[0]*axes_d[0]
+                                         + axes_d[1]*axes_d[1]
+                                         + axes_d[2]*axes_d[2])
         if move_d < .000000001:
             # Extrude only move
             self.end_pos = (start_pos[0], start_pos[1], start_pos[2],
@@ -36,7 +54,11 @@ class Move:
             self.is_kinematic_move = False
         else:
             inv_move_d = 1. / move_d
-        self.axes_r = [d * inv_move_d for d in axes_d]
+        axes_r = self.axes_r
+        axes_r[0] = axes_d[0] * inv_move_d
+        axes_r[1] = axes_d[1] * inv_move_d
+        axes_r[2] = axes_d[2] * inv_move_d
+        axes_r[3] = axes_d[3] * inv_move_d
         self.min_move_t = move_d / velocity
         # Junction speeds are tracked in velocity squared.  The
         # delta_v2 is the maximum amount of this squared-velocity that
@@ -46,6 +68,7 @@ class Move:
         self.delta_v2 = 2.0 * move_d * self.accel
         self.max_smoothed_v2 = 0.
         self.smooth_delta_v2 = 2.0 * move_d * toolhead.max_accel_to_decel
+        self.checked_smoothed_v2 = -1.
     def limit_speed(self, speed, accel):
         speed2 = speed**2
         if speed2 < self.max_cruise_v2:
@@ -100,6 +123,7 @@ class Move:
         self.decel_t = decel_d / ((end_v + cruise_v) * 0.5)
 
 LOOKAHEAD_FLUSH_TIME = 0.250
+MAX_FREE_MOVES = 1024
 
 # Class to track a list of pending move requests and to facilitate
 # "look-ahead" across moves to reduce acceleration between moves.
@@ -107,7 +131,14 @@ class MoveQueue:
     def __init__(self, toolhead):
         self.toolhead = toolhead
         self.queue = []
+        self.free_moves = []
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
+    def alloc_move(self, start_pos, end_pos, speed):
+        if self.free_moves:
+            move = self.free_moves.pop()
+            move.setup(start_pos, end_pos, speed)
+            return move
+        return Move(self.toolhead, start_pos, end_pos, speed)
     def reset(self):
         del self.queue[:]
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
@@ -118,6 +149,27 @@ class MoveQueue:
             return self.queue[-1]
         return None
     def flush(self, lazy=False):
+        toolhead = self.toolhead
+        start_time = toolhead.reactor.monotonic()
+        flush_count = self._plan_junctions(lazy)
+        toolhead.note_phase_time('lookahead', start_time)
+        if not flush_count:
+            return
+        # Generate step times for all moves ready to be flushed
+        queue = self.queue
+        moves = queue[:flush_count]
+        toolhead._process_moves(moves)
+        # Remove processed moves from the queue (and reuse them)
+        del queue[:flush_count]
+        for move in moves:
+            if move.timing_callbacks:
+                del move.timing_callbacks[:]
+        free_moves = self.free_moves
+        if len(free_moves) < MAX_FREE_MOVES:
+            free_moves.extend(moves)
+    def _plan_junctions(self, lazy):
+        # Returns the number of moves at the start of the queue that
+        # are ready to be flushed
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
         update_flush_count = lazy
         queue = self.queue
@@ -129,6 +181,16 @@ class MoveQueue:
         next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
         for i in range(flush_count-1, -1, -1):
             move = queue[i]
+            if update_flush_count:
+                # A previous lazy flush that reached this move in the
+                # same state did not find a flush point before it - no
+                # need to traverse the remainder of the queue again.
+                if peak_cruise_v2 and not delayed:
+                    if move.checked_smoothed_v2 == next_smoothed_v2:
+                        return 0
+                    move.checked_smoothed_v2 = next_smoothed_v2
+                else:
+                    move.checked_smoothed_v2 = -1.
             reachable_start_v2 = next_end_v2 + move.delta_v2
             start_v2 = min(move.max_start_v2, reachable_start_v2)
             reachable_smoothed_v2 = next_smoothed_v2 + move.smooth_delta_v2
@@ -163,12 +225,9 @@ class MoveQueue:
                 delayed.append((move, start_v2, next_end_v2))
             next_end_v2 = start_v2
             next_smoothed_v2 = smoothed_v2
-        if update_flush_count or not flush_count:
-            return
-        # Generate step times for all moves ready to be flushed
-        self.toolhead._process_moves(queue[:flush_count])
-        # Remove processed moves from the queue
-        del queue[:flush_count]
+        if update_flush_count:
+            return 0
+        return flush_count
     def add_move(self, move):
         self.queue.append(move)
         if len(self.queue) == 1:
@@ -182,11 +241,165 @@ class MoveQueue:
 MIN_KIN_TIME = 0.100
 MOVE_BATCH_TIME = 0.500
 
+PHASES = ['lookahead', 'trapq', 'step_gen', 'mcu_flush']
+
 DRIP_SEGMENT_TIME = 0.050
 DRIP_TIME = 0.100
 class DripModeEndSignal(Exception):
     pass
 
+# Generate steps for the registered step generators using multiple
+# threads.  The C step generation code runs without holding the GIL,
+# so steppers can be processed on separate cores.  The main thread
+# handles one share of the step generators and waits for the worker
+# threads to complete the remaining shares.
+class StepGenThreads:
+    def __init__(self, thread_count):
+        self.done_queue = Queue.Queue()
+        self.work_queues = []
+        self.threads = []
+        for i in range(thread_count - 1):
+            work_queue = Queue.Queue()
+            t = threading.Thread(target=self._worker_thread,
+                                 args=(work_queue,))
+            t.daemon = True
+            t.start()
+            self.work_queues.append(work_queue)
+            self.threads.append(t)
+    def stop(self):
+        # Signal the worker threads to exit and wait for them
+        for work_queue in self.work_queues:
+            work_queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.work_queues = []
+        self.threads = []
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            return e
+        return None
+    def _worker_thread(self, work_queue):
+        while 1:
+            work = work_queue.get()
+            if work is None:
+                break
+            index, func, args = work
+            self.done_queue.put((index, self._run(func, args)))
+    def _run_shared(self, func, shares):
+        # Run func on each set of args in 'shares' (the first in the
+        # calling thread) and wait for all of them to complete
+        for i, work_queue in enumerate(self.work_queues[:len(shares)-1]):
+            work_queue.put((i + 1, func, shares[i+1]))
+        errors = [self._run(func, shares[0])] + [None] * (len(shares) - 1)
+        for i in range(len(shares) - 1):
+            index, e = self.done_queue.get()
+            errors[index] = e
+        return errors
+    def _check_errors(self, errors):
+        # Report the first error (in share order)
+        for e in errors:
+            if e is not None:
+                raise e
+    def _generate(self, step_generators, pending, flush_time):
+        for sg, pending_callbacks in zip(step_generators, pending):
+            sg(flush_time, pending_callbacks)
+    def generate_steps(self, step_generators, flush_time):
+        share_count = len(self.work_queues) + 1
+        pending = [[] for sg in step_generators]
+        errors = self._run_shared(self._generate, [
+            (step_generators[i::share_count], pending[i::share_count],
+             flush_time) for i in range(share_count)])
+        # Invoke any stepper activity callbacks (in step generator order)
+        for pending_callbacks in pending:
+            for cb, print_time in pending_callbacks:
+                cb(print_time)
+        self._check_errors(errors)
+    def _flush(self, mcus, flush_time):
+        for m in mcus:
+            m.flush_moves(flush_time)
+    def flush_moves(self, mcus, flush_time):
+        share_count = min(len(self.work_queues) + 1, len(mcus))
+        if share_count <= 1:
+            self._flush(mcus, flush_time)
+            return
+        self._check_errors(self._run_shared(self._flush, [
+            (mcus[i::share_count], flush_time) for i in range(share_count)]))
+
+# Adaptive tuning of the buffer_time_low/high/start targets from the
+# measured host scheduling latency (reactor wakeup lateness and the
+# time needed to process and flush moves)
+BUFFER_TUNE_WINDOW = 30.
+BUFFER_LOW_FACTOR = 5.
+BUFFER_START_FACTOR = 2.
+class BufferTimeTuner:
+    def __init__(self, toolhead, config):
+        self.toolhead = toolhead
+        # The configured buffer times are the upper bounds
+        self.low_max = toolhead.buffer_time_low
+        self.high_max = toolhead.buffer_time_high
+        self.start_max = toolhead.buffer_time_start
+        self.low_min = config.getfloat('buffer_time_low_min', 0.250,
+                                       above=0., maxval=self.low_max)
+        self.start_min = config.getfloat('buffer_time_start_min', 0.100,
+                                         above=0., maxval=self.start_max)
+        # Latency is the maximum seen over the current and last window
+        self.window_end = 0.
+        self.window_latency = self.last_latency = self.max_latency = 0.
+        self.low_flush_count = self.underrun_count = 0
+    def _update_targets(self):
+        latency = max(self.window_latency, self.last_latency)
+        low = min(max(BUFFER_LOW_FACTOR * latency, self.low_min),
+                  self.low_max)
+        start = min(max(BUFFER_START_FACTOR * latency, self.start_min),
+                    self.start_max)
+        toolhead = self.toolhead
+        toolhead.buffer_time_low = low
+        toolhead.buffer_time_high = low + self.high_max - self.low_max
+        toolhead.buffer_time_start = start
+    def note_latency(self, eventtime, latency):
+        if eventtime >= self.window_end:
+            # Start a new window
+            if eventtime >= self.window_end + BUFFER_TUNE_WINDOW:
+                self.window_latency = 0.
+            self.last_latency = self.window_latency
+            self.window_latency = latency
+            self.window_end = eventtime + BUFFER_TUNE_WINDOW
+            self._update_targets()
+        elif latency > self.window_latency:
+            self.window_latency = latency
+            self._update_targets()
+        if latency > self.max_latency:
+            self.max_latency = latency
+    def note_low_flush(self):
+        self.low_flush_count += 1
+    def note_underrun(self, eventtime):
+        # Double the buffer targets (until the latency window expires)
+        self.underrun_count += 1
+        self.note_latency(eventtime, (2. * self.toolhead.buffer_time_low
+                                      / BUFFER_LOW_FACTOR))
+    def stats(self):
+        toolhead = self.toolhead
+        return ("buffer_time_low=%.3f buffer_time_high=%.3f"
+                " buffer_time_start=%.3f buffer_latency=%.6f"
+                " buffer_latency_max=%.6f buffer_low_flush=%d"
+                " buffer_underrun=%d" % (
+                    toolhead.buffer_time_low, toolhead.buffer_time_high,
+                    toolhead.buffer_time_start,
+                    max(self.window_latency, self.last_latency),
+                    self.max_latency, self.low_flush_count,
+                    self.underrun_count))
+    def get_status(self):
+        toolhead = self.toolhead
+        return {'buffer_time_low': toolhead.buffer_time_low,
+                'buffer_time_high': toolhead.buffer_time_high,
+                'buffer_time_start': toolhead.buffer_time_start,
+                'latency': max(self.window_latency, self.last_latency),
+                'latency_max': self.max_latency,
+                'low_flush_count': self.low_flush_count,
+                'underrun_count': self.underrun_count}
+
 # Main code to track events (and their timing) on the printer toolhead
 class ToolHead:
     def __init__(self, config):
@@ -202,6 +415,8 @@ class ToolHead:
         self.commanded_pos = [0., 0., 0., 0.]
         self.printer.register_event_handler("klippy:shutdown",
                                             self._handle_shutdown)
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self._handle_disconnect)
         # Velocity and acceleration control
         self.max_velocity = config.getfloat('max_velocity', above=0.)
         self.max_accel = config.getfloat('max_accel', above=0.)
@@ -224,6 +439,12 @@ class ToolHead:
             'buffer_time_start', 0.250, above=0.)
         self.move_flush_time = config.getfloat(
             'move_flush_time', 0.050, above=0.)
+        self.buffer_tuner = None
+        if config.getboolean('buffer_time_adaptive', False):
+            buffer_tuner = BufferTimeTuner(self, config)
+            if self.can_pause:
+                # Not used in batch mode (to keep its output repeatable)
+                self.buffer_tuner = buffer_tuner
         self.print_time = 0.
         self.special_queuing_state = "Flushed"
         self.need_check_stall = -1.
@@ -232,6 +453,8 @@ class ToolHead:
         self.last_print_start_time = 0.
         self.idle_flush_print_time = 0.
         self.print_stall = 0
+        # Cumulative and maximum time spent in each processing phase
+        self.phase_times = dict([(phase, [0., 0.]) for phase in PHASES])
         self.drip_completion = None
         # Kinematic step generation scan window time tracking
         self.kin_flush_delay = 0.
@@ -240,9 +463,12 @@ class ToolHead:
         # Setup iterative solver
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
-        self.trapq_append = ffi_lib.trapq_append
+        self.trapq_append_batch = ffi_lib.trapq_append_batch
         self.trapq_free_moves = ffi_lib.trapq_free_moves
         self.step_generators = []
+        self.step_gen_threads = None
+        self._setup_step_gen_threads(
+            config.getint('step_generation_threads', 1, minval=1))
         # Create kinematics class
         self.extruder = kinematics.extruder.DummyExtruder()
         kin_name = config.get('kinematics')
@@ -268,6 +494,18 @@ class ToolHead:
         self.printer.try_load_module(config, "statistics")
         self.printer.try_load_module(config, "manual_probe")
         self.printer.try_load_module(config, "tuning_tower")
+    def note_phase_time(self, phase, start_time):
+        end_time = self.reactor.monotonic()
+        elapsed = end_time - start_time
+        phase_time = self.phase_times[phase]
+        phase_time[0] += elapsed
+        if elapsed > phase_time[1]:
+            phase_time[1] = elapsed
+        return end_time
+    def _setup_step_gen_threads(self, thread_count):
+        self.step_gen_threads = None
+        if thread_count > 1:
+            self.step_gen_threads = StepGenThreads(thread_count)
     # Print time tracking
     def _update_move_time(self, next_print_time):
         batch_time = MOVE_BATCH_TIME
@@ -276,14 +514,25 @@ class ToolHead:
         while 1:
             self.print_time = min(self.print_time + batch_time, next_print_time)
             sg_flush_time = max(lkft, self.print_time - kin_flush_delay)
-            for sg in self.step_generators:
-                sg(sg_flush_time)
+            start_time = self.reactor.monotonic()
+            if self.step_gen_threads is not None:
+                self.step_gen_threads.generate_steps(self.step_generators,
+                                                     sg_flush_time)
+            else:
+                for sg in self.step_generators:
+                    sg(sg_flush_time)
             free_time = max(lkft, sg_flush_time - kin_flush_delay)
             self.trapq_free_moves(self.trapq, free_time)
             self.extruder.update_move_time(free_time)
+            start_time = self.note_phase_time('step_gen', start_time)
             mcu_flush_time = max(lkft, sg_flush_time - self.move_flush_time)
-            for m in self.all_mcus:
-                m.flush_moves(mcu_flush_time)
+            if self.step_gen_threads is not None:
+                self.step_gen_threads.flush_moves(self.all_mcus,
+                                                  mcu_flush_time)
+            else:
+                for m in self.all_mcus:
+                    m.flush_moves(mcu_flush_time)
+            self.note_phase_time('mcu_flush', start_time)
             if self.print_time >= next_print_time:
                 break
     def _calc_print_time(self):
@@ -297,6 +546,7 @@ class ToolHead:
             self.printer.send_event("toolhead:sync_print_time",
                                     curtime, est_print_time, self.print_time)
     def _process_moves(self, moves):
+        start_time = self.reactor.monotonic()
         # Resync print_time if necessary
         if self.special_queuing_state:
             if self.special_queuing_state != "Drip":
@@ -307,25 +557,36 @@ class ToolHead:
             self._calc_print_time()
         # Queue moves into trapezoid motion queue (trapq)
         next_move_time = self.print_time
+        trapq_moves = []
         for move in moves:
             if move.is_kinematic_move:
-                self.trapq_append(
-                    self.trapq, next_move_time,
-                    move.accel_t, move.cruise_t, move.decel_t,
-                    move.start_pos[0], move.start_pos[1], move.start_pos[2],
-                    move.axes_r[0], move.axes_r[1], move.axes_r[2],
-                    move.start_v, move.cruise_v, move.accel)
+                start_pos = move.start_pos
+                axes_r = move.axes_r
+                trapq_moves.extend((
+                    next_move_time, move.accel_t, move.cruise_t, move.decel_t,
+                    start_pos[0], start_pos[1], start_pos[2],
+                    axes_r[0], axes_r[1], axes_r[2],
+                    move.start_v, move.cruise_v, move.accel))
             if move.axes_d[3]:
                 self.extruder.move(next_move_time, move)
             next_move_time = (next_move_time + move.accel_t
                               + move.cruise_t + move.decel_t)
             for cb in move.timing_callbacks:
                 cb(next_move_time)
+        if trapq_moves:
+            self.trapq_append_batch(
+                self.trapq, trapq_moves,
+                len(trapq_moves) // chelper.TRAPQ_APPEND_SIZE)
+        self.extruder.submit_moves()
+        self.note_phase_time('trapq', start_time)
         # Generate steps for moves
         if self.special_queuing_state:
             self._update_drip_move_time(next_move_time)
         self._update_move_time(next_move_time)
         self.last_kin_move_time = next_move_time
+        if self.buffer_tuner is not None and not self.special_queuing_state:
+            end_time = self.reactor.monotonic()
+            self.buffer_tuner.note_latency(end_time, end_time - start_time)
     def flush_step_generation(self):
         # Transition from "Flushed"/"Priming"/main state to "Flushed" state
         self.move_queue.flush()
@@ -354,6 +615,8 @@ class ToolHead:
                 est_print_time = self.mcu.estimated_print_time(eventtime)
                 if est_print_time < self.idle_flush_print_time:
                     self.print_stall += 1
+                    if self.buffer_tuner is not None:
+                        self.buffer_tuner.note_underrun(eventtime)
                 self.idle_flush_print_time = 0.
             # Transition from "Flushed"/"Priming" state to "Priming" state
             self.special_queuing_state = "Priming"
@@ -369,7 +632,10 @@ class ToolHead:
             if not self.can_pause:
                 self.need_check_stall = self.reactor.NEVER
                 return
-            eventtime = self.reactor.pause(eventtime + min(1., stall_time))
+            waketime = eventtime + min(1., stall_time)
+            eventtime = self.reactor.pause(waketime)
+            if self.buffer_tuner is not None:
+                self.buffer_tuner.note_latency(eventtime, eventtime - waketime)
         if not self.special_queuing_state:
             # In main state - defer stall checking until needed
             self.need_check_stall = (est_print_time + self.buffer_time_high
@@ -385,6 +651,10 @@ class ToolHead:
             self.flush_step_generation()
             if print_time != self.print_time:
                 self.idle_flush_print_time = self.print_time
+            if self.buffer_tuner is not None:
+                self.buffer_tuner.note_low_flush()
+                end_time = self.reactor.monotonic()
+                self.buffer_tuner.note_latency(end_time, end_time - eventtime)
         except:
             logging.exception("Exception in flush_handler")
             self.printer.invoke_shutdown("Exception in flush_handler")
@@ -398,7 +668,7 @@ class ToolHead:
         self.commanded_pos[:] = newpos
         self.kin.set_position(newpos, homing_axes)
     def move(self, newpos, speed):
-        move = Move(self, self.commanded_pos, newpos, speed)
+        move = self.move_queue.alloc_move(self.commanded_pos, newpos, speed)
         if not move.move_d:
             return
         if move.is_kinematic_move:
@@ -474,8 +744,15 @@ class ToolHead:
         is_active = buffer_time > -60. or not self.special_queuing_state
         if self.special_queuing_state == "Drip":
             buffer_time = 0.
-        return is_active, "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
+        msg = "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
             self.print_time, max(buffer_time, 0.), self.print_stall)
+        for phase in PHASES:
+            total, max_time = self.phase_times[phase]
+            msg += " %s_time=%.3f %s_max=%.6f" % (
+                phase, total, phase, max_time)
+        if self.buffer_tuner is not None:
+            msg += " " + self.buffer_tuner.stats()
+        return is_active, msg
     def check_busy(self, eventtime):
         est_print_time = self.mcu.estimated_print_time(eventtime)
         lookahead_empty = not self.move_queue.queue
@@ -494,11 +771,20 @@ class ToolHead:
                      'estimated_print_time': estimated_print_time,
                      'extruder': self.extruder.get_name(),
                      'position': homing.Coord(*self.commanded_pos),
-                     'printing_time': print_time - last_print_start_time })
+                     'printing_time': print_time - last_print_start_time,
+                     'phase_times': dict([
+                         (phase, {'total': total, 'max': max_time})
+                         for phase, (total, max_time)
+                         in self.phase_times.items()]) })
+        if self.buffer_tuner is not None:
+            res['buffer_tuning'] = self.buffer_tuner.get_status()
         return res
     def _handle_shutdown(self):
         self.can_pause = False
         self.move_queue.reset()
+    def _handle_disconnect(self):
+        if self.step_gen_threads is not None:
+            self.step_gen_threads.stop()
     def get_kinematics(self):
         return self.kin
     def get_trapq(self):
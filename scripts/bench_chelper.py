@@ -0,0 +1,222 @@
+#!/usr/bin/env python2
+# Benchmark the chelper step generation and step compression code
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, math, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import chelper
+
+MCU_FREQ = 16000000.
+MAX_ERROR = .000025
+FLUSH_TIME = .250
+DELTA_ARM_LENGTH = 333.
+DELTA_RADIUS = 174.75
+
+
+######################################################################
+# Move patterns
+######################################################################
+
+# Generate trapq_append_batch() records for a path through the given
+# points (moves are joined at 'junction_v' where acceleration permits)
+def gen_path(points, speed, accel, junction_v):
+    moves = []
+    for start_pos, end_pos in zip(points[:-1], points[1:]):
+        axes_d = [ep - sp for sp, ep in zip(start_pos, end_pos)]
+        move_d = math.sqrt(sum([d*d for d in axes_d]))
+        if move_d:
+            moves.append((start_pos, [d / move_d for d in axes_d], move_d))
+    # Limit the junction speeds to what acceleration can reach
+    junctions = [0.] + [junction_v] * (len(moves) - 1) + [0.]
+    for i, (start_pos, axes_r, move_d) in enumerate(moves):
+        junctions[i+1] = min(junctions[i+1], math.sqrt(
+            junctions[i]**2 + 2. * accel * move_d))
+    for i in range(len(moves) - 1, -1, -1):
+        junctions[i] = min(junctions[i], math.sqrt(
+            junctions[i+1]**2 + 2. * accel * moves[i][2]))
+    records = []
+    print_time = 1.
+    for i, (start_pos, axes_r, move_d) in enumerate(moves):
+        start_v, end_v = junctions[i], junctions[i+1]
+        cruise_v = min(speed, math.sqrt(
+            accel * move_d + .5 * (start_v**2 + end_v**2)))
+        accel_t = (cruise_v - start_v) / accel
+        decel_t = (cruise_v - end_v) / accel
+        accel_d = (start_v + cruise_v) * .5 * accel_t
+        decel_d = (end_v + cruise_v) * .5 * decel_t
+        cruise_t = max(0., (move_d - accel_d - decel_d) / cruise_v)
+        records.extend((print_time, accel_t, cruise_t, decel_t)
+                       + tuple(start_pos) + tuple(axes_r)
+                       + (start_v, cruise_v, accel))
+        print_time += accel_t + cruise_t + decel_t
+    return records, print_time
+
+# Long diagonal moves across the bed
+def gen_cruise(count):
+    points = [[(-70., 70.)[i & 1], (-70., 70.)[i & 1], 1.]
+              for i in range(count + 1)]
+    return gen_path(points, 300., 3000., 0.)
+
+# Short back and forth moves (similar to infill)
+def gen_zigzag(count):
+    points = [[(-1., 1.)[i & 1], -40. + i * .01, 1.]
+              for i in range(count + 1)]
+    return gen_path(points, 100., 3000., 0.)
+
+# Small segments of a circle (similar to a curved perimeter)
+def gen_arc(count):
+    points = [[40. * math.cos(i * .0125), 40. * math.sin(i * .0125), 1.]
+              for i in range(count + 1)]
+    return gen_path(points, 100., 3000., 100.)
+
+# Short moves close to each delta tower (where the carriages of the
+# other towers move quickly)
+def gen_delta_tower(count):
+    points = []
+    for i in range(count + 1):
+        angle = math.radians(210. + 120. * ((3 * i) // (count + 1)))
+        dist = .8 * DELTA_RADIUS + (-2.5, 2.5)[i & 1]
+        offset = (i % 50) * .2 - 5.
+        points.append([dist * math.cos(angle) - offset * math.sin(angle),
+                       dist * math.sin(angle) + offset * math.cos(angle), 1.])
+    return gen_path(points, 100., 3000., 0.)
+
+PATTERNS = [
+    ('cruise', gen_cruise, 200), ('zigzag', gen_zigzag, 20000),
+    ('arc', gen_arc, 20000), ('delta_tower', gen_delta_tower, 20000),
+]
+
+
+######################################################################
+# Kinematics
+######################################################################
+
+def get_delta_steppers():
+    arm2 = DELTA_ARM_LENGTH**2
+    steppers = []
+    for angle in [210., 330., 90.]:
+        angle = math.radians(angle)
+        steppers.append(('delta_stepper_alloc', .01, (
+            arm2, math.cos(angle) * DELTA_RADIUS,
+            math.sin(angle) * DELTA_RADIUS)))
+    return steppers
+
+# Stepper kinematics of each robot type: (alloc func, step_dist, params)
+KINEMATICS = [
+    ('cartesian', [('cartesian_stepper_alloc', .0125, ('x',)),
+                   ('cartesian_stepper_alloc', .0125, ('y',)),
+                   ('cartesian_stepper_alloc', .0025, ('z',))]),
+    ('corexy', [('corexy_stepper_alloc', .0125, ('+',)),
+                ('corexy_stepper_alloc', .0125, ('-',)),
+                ('cartesian_stepper_alloc', .0025, ('z',))]),
+    ('delta', get_delta_steppers()),
+]
+
+
+######################################################################
+# Benchmark
+######################################################################
+
+# Generate and compress the steps for the given moves
+def run_steps(steppers, records, end_time, iterative):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    output_fd = os.open(os.devnull, os.O_WRONLY)
+    sq = ffi_lib.serialqueue_alloc(output_fd, 1)
+    ffi_lib.serialqueue_set_clock_est(sq, 1000000000000.,
+                                      ffi_lib.get_monotonic(), 0)
+    tq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+    ffi_lib.trapq_append_batch(tq, records,
+                               len(records) // chelper.TRAPQ_APPEND_SIZE)
+    stepqueues = []
+    sks = []
+    for oid, (alloc_func, step_dist, params) in enumerate(steppers):
+        sc = ffi_main.gc(ffi_lib.stepcompress_alloc(oid),
+                         ffi_lib.stepcompress_free)
+        ffi_lib.stepcompress_fill(sc, int(MAX_ERROR * MCU_FREQ), 0, 1, 2)
+        stepqueues.append(sc)
+        sk = ffi_main.gc(getattr(ffi_lib, alloc_func)(*params), ffi_lib.free)
+        if iterative:
+            ffi_lib.itersolve_set_linear(sk, 0., 0., 0.)
+        ffi_lib.itersolve_set_stepcompress(sk, sc, step_dist)
+        ffi_lib.itersolve_set_trapq(sk, tq)
+        ffi_lib.itersolve_set_position(sk, *records[4:7])
+        sks.append(sk)
+    ss = ffi_main.gc(ffi_lib.steppersync_alloc(sq, stepqueues,
+                                               len(stepqueues), 16),
+                     ffi_lib.steppersync_free)
+    ffi_lib.steppersync_set_time(ss, 0., MCU_FREQ)
+    gen_time = compress_time = 0.
+    flush_time = 1.
+    while flush_time < end_time + FLUSH_TIME:
+        flush_time += FLUSH_TIME
+        start_time = time.time()
+        for sk in sks:
+            ret = ffi_lib.itersolve_generate_steps(sk, flush_time)
+            if ret:
+                raise Exception("Internal error in stepcompress")
+        gen_time += time.time() - start_time
+        start_time = time.time()
+        ret = ffi_lib.steppersync_flush(ss, int(flush_time * MCU_FREQ))
+        if ret:
+            raise Exception("Internal error in stepcompress")
+        compress_time += time.time() - start_time
+        ffi_lib.trapq_free_moves(tq, flush_time)
+    ffi_lib.serialqueue_exit(sq)
+    ffi_lib.serialqueue_free(sq)
+    os.close(output_fd)
+    # Collect stepcompress statistics
+    steps = queue_steps = 0
+    stats = ffi_main.new('struct stepcompress_stats *')
+    for sc in stepqueues:
+        ffi_lib.stepcompress_get_stats(sc, stats)
+        steps += stats.step_count
+        queue_steps += stats.queue_step_count
+    return steps, queue_steps, gen_time, compress_time
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-k", "--kinematics", type="string", dest="kinematics",
+                    default=",".join([k for k, s in KINEMATICS]),
+                    help="comma separated list of kinematics to test")
+    opts.add_option("-p", "--patterns", type="string", dest="patterns",
+                    default=",".join([p for p, f, c in PATTERNS]),
+                    help="comma separated list of move patterns to test")
+    opts.add_option("-s", "--scale", type="float", dest="scale", default=1.,
+                    help="multiplier for the number of moves in each pattern")
+    opts.add_option("-i", "--iterative", action="store_true",
+                    dest="iterative", help="disable the closed-form solver")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    kin_names = options.kinematics.split(',')
+    pattern_names = options.patterns.split(',')
+    for name in kin_names:
+        if name not in [k for k, s in KINEMATICS]:
+            opts.error("Unknown kinematics '%s'" % (name,))
+    for name in pattern_names:
+        if name not in [p for p, f, c in PATTERNS]:
+            opts.error("Unknown pattern '%s'" % (name,))
+    print "%-10s %-12s %10s %12s %12s %14s %8s" % (
+        "kinematics", "pattern", "moves", "steps", "steps/s",
+        "queue_step/s", "ratio")
+    for pattern_name, gen_func, count in PATTERNS:
+        if pattern_name not in pattern_names:
+            continue
+        count = max(1, int(count * options.scale))
+        records, end_time = gen_func(count)
+        for kin_name, steppers in KINEMATICS:
+            if kin_name not in kin_names:
+                continue
+            steps, queue_steps, gen_time, compress_time = run_steps(
+                steppers, records, end_time, options.iterative)
+            print "%-10s %-12s %10d %12d %12.0f %14.0f %8.2f" % (
+                kin_name, pattern_name,
+                len(records) // chelper.TRAPQ_APPEND_SIZE, steps,
+                steps / gen_time, queue_steps / compress_time,
+                float(steps) / max(1, queue_steps))
+
+if __name__ == '__main__':
+    main()
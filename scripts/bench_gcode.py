@@ -0,0 +1,84 @@
+#!/usr/bin/env python2
+# Benchmark the host g-code line parser
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import reactor, gcode
+
+# Minimal printer object sufficient to instantiate the g-code parser
+class BenchPrinter:
+    def __init__(self):
+        self.reactor = reactor.Reactor()
+    def register_event_handler(self, event, callback):
+        pass
+    def get_reactor(self):
+        return self.reactor
+    def get_start_args(self):
+        return {'debuginput': 'benchmark'}
+
+def load_lines(filename, count):
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+    lines = []
+    for line in data.split('\n'):
+        line = line.strip()
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        lines.append(line)
+    return lines * count
+
+def run_general(gc, lines):
+    parse_line = gc._parse_line
+    for line in lines:
+        parse_line(line)
+
+def run_dispatch(gc, lines):
+    parse_traditional_line = gc._parse_traditional_line
+    parse_line = gc._parse_line
+    for line in lines:
+        params = parse_traditional_line(line)
+        if params is None:
+            params = parse_line(line)
+
+def time_func(func, gc, lines, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func(gc, lines)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    usage = "%prog [options] <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count", default=20000,
+                    help="number of times to replicate the input file")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of timing runs (best is reported)")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    lines = load_lines(args[0], options.count)
+    gc = gcode.GCodeParser(BenchPrinter(), None)
+    # Verify the fast path produces the same results as the general parser
+    for line in set(lines):
+        params = gc._parse_traditional_line(line)
+        if params is not None and params != gc._parse_line(line):
+            sys.stderr.write("Parser mismatch on '%s'\n" % (line,))
+            sys.exit(-1)
+    general_time = time_func(run_general, gc, lines, options.repeat)
+    dispatch_time = time_func(run_dispatch, gc, lines, options.repeat)
+    print "lines: %d" % (len(lines),)
+    print "general parser: %.0f lines/second" % (len(lines) / general_time,)
+    print "fast path parser: %.0f lines/second (%.2fx)" % (
+        len(lines) / dispatch_time, general_time / dispatch_time)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python2
+# Benchmark the full host pipeline in batch (file output) mode
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, logging, tempfile
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import klippy, chelper, toolhead
+
+CONFIGS_DIR = os.path.join(os.path.dirname(__file__), '../test/configs')
+PRINTERS_TEST = os.path.join(os.path.dirname(__file__),
+                             '../test/klippy/printers.test')
+
+# Count the moves submitted to step generation
+class MoveCounter:
+    def __init__(self, printer):
+        self.printer = printer
+        self.move_count = 0
+        printer.register_event_handler("klippy:connect", self.handle_connect)
+    def handle_connect(self):
+        self.toolhead = self.printer.lookup_object('toolhead')
+        self.orig_process_moves = self.toolhead._process_moves
+        self.toolhead._process_moves = self.process_moves
+    def process_moves(self, moves):
+        self.move_count += len(moves)
+        self.orig_process_moves(moves)
+
+# Sum the step statistics of all the steppers on all mcus
+def get_step_count(printer):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    stats = ffi_main.new('struct stepcompress_stats *')
+    steps = 0
+    for name, mcu in printer.lookup_objects(module='mcu'):
+        for sc in mcu._stepqueues:
+            ffi_lib.stepcompress_get_stats(sc, stats)
+            steps += stats.step_count
+    return steps
+
+# Process a g-code file with the given config and mcu data dictionaries
+def run_klippy(config_file, gcode_file, dictionaries):
+    output_fd, output_name = tempfile.mkstemp(prefix='bench_klippy')
+    os.close(output_fd)
+    start_args = {'config_file': config_file, 'start_reason': 'startup',
+                  'debuginput': gcode_file, 'debugoutput': output_name,
+                  'software_version': 'benchmark'}
+    start_args.update(dictionaries)
+    debuginput = open(gcode_file, 'rb')
+    printer = klippy.Printer(debuginput.fileno(), None, start_args)
+    counter = MoveCounter(printer)
+    start_time = time.time()
+    res = printer.run()
+    total_time = time.time() - start_time
+    debuginput.close()
+    # Each secondary mcu writes to its own output file
+    output_names = [output_name] + [
+        output_name + '-' + name[len('dictionary_'):]
+        for name in dictionaries if name.startswith('dictionary_')]
+    output_size = 0
+    for fname in output_names:
+        if os.path.exists(fname):
+            output_size += os.path.getsize(fname)
+            os.unlink(fname)
+    if res != 'exit':
+        return None
+    phase_times = printer.lookup_object('toolhead').phase_times
+    return {'time': total_time, 'moves': counter.move_count,
+            'steps': get_step_count(printer), 'bytes': output_size,
+            'phases': dict([(phase, total)
+                            for phase, (total, max_time)
+                            in phase_times.items()])}
+
+# Find the first printer config (and its dictionaries) that the
+# printers.test regression test uses with each mcu data dictionary
+def load_printer_configs(dict_dir):
+    out = {}
+    f = open(PRINTERS_TEST, 'rb')
+    data = f.read()
+    f.close()
+    name = dictionaries = None
+    for line in data.split('\n'):
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        if parts[0] == 'DICTIONARY':
+            dictionaries = {'dictionary': os.path.join(dict_dir, parts[1])}
+            for mcu_dict in parts[2:]:
+                mcu_name, fname = mcu_dict.split('=', 1)
+                dictionaries['dictionary_' + mcu_name] = os.path.join(
+                    dict_dir, fname)
+            name = os.path.splitext(parts[1])[0]
+        elif parts[0] == 'CONFIG' and name is not None and name not in out:
+            config_file = os.path.join(os.path.dirname(PRINTERS_TEST),
+                                       parts[1])
+            out[name] = (config_file, dictionaries)
+    return out
+
+def main():
+    usage = "%prog [options] <gcode file> <dictionary directory>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--config", type="string", dest="config",
+                    help="printer config file to use with every mcu")
+    opts.add_option("-m", "--mcus", type="string", dest="mcus",
+                    help="comma separated list of test/configs builds")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=1,
+                    help="number of timing runs (best is reported)")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    gcode_file, dict_dir = args
+    logging.basicConfig(level=logging.CRITICAL)
+    names = [os.path.splitext(fname)[0]
+             for fname in sorted(os.listdir(CONFIGS_DIR))
+             if fname.endswith('.config')]
+    if options.mcus is not None:
+        names = [name for name in names if name in options.mcus.split(',')]
+    printer_configs = load_printer_configs(dict_dir)
+    f = open(gcode_file, 'rb')
+    line_count = len(f.read().split('\n'))
+    f.close()
+    print "%-18s %10s %10s %12s %10s %10s  %s" % (
+        "mcu", "lines/s", "moves/s", "steps/s", "bytes", "bytes/move",
+        " ".join(["%s_time" % (phase,) for phase in toolhead.PHASES]))
+    for name in names:
+        dictionaries = {'dictionary': os.path.join(dict_dir, name + '.dict')}
+        config_file = options.config
+        if config_file is None:
+            if name not in printer_configs:
+                print "%-18s (no printer config for this mcu)" % (name,)
+                continue
+            config_file, dictionaries = printer_configs[name]
+        if not all([os.path.exists(d) for d in dictionaries.values()]):
+            print "%-18s (no data dictionary)" % (name,)
+            continue
+        best = None
+        for i in range(options.repeat):
+            res = run_klippy(config_file, gcode_file, dictionaries)
+            if res is None:
+                break
+            if best is None or res['time'] < best['time']:
+                best = res
+        if best is None:
+            print "%-18s (error processing %s)" % (
+                name, os.path.basename(config_file))
+            continue
+        total_time = best['time']
+        print "%-18s %10.0f %10.0f %12.0f %10d %10.2f  %s" % (
+            name, line_count / total_time, best['moves'] / total_time,
+            best['steps'] / total_time, best['bytes'],
+            float(best['bytes']) / max(1, best['moves']),
+            " ".join(["%*.3f" % (len(phase) + 5, best['phases'][phase])
+                      for phase in toolhead.PHASES]))
+
+if __name__ == '__main__':
+    main()
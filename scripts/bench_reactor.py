@@ -0,0 +1,61 @@
+#!/usr/bin/env python2
+# Benchmark the host reactor timer dispatch
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import reactor
+
+# Measure the rate one busy timer can be invoked while "idle" other
+# timers (eg, heater and fan updates) are registered
+def bench_wakeups(timer_count, duration):
+    r = reactor.Reactor()
+    start_time = r.monotonic()
+    for i in range(timer_count - 1):
+        r.register_timer((lambda e: e + 1000.), start_time + 1000. + i)
+    counts = [0]
+    end_time = start_time + duration
+    def busy_timer(eventtime):
+        counts[0] += 1
+        if eventtime >= end_time:
+            r.end()
+            return r.NEVER
+        return r.NOW
+    r.register_timer(busy_timer, r.NOW)
+    r.run()
+    return counts[0] / (r.monotonic() - start_time)
+
+# Measure the rate that timers can be registered, updated, and removed
+def bench_register(timer_count, repeat):
+    r = reactor.Reactor()
+    start_time = r.monotonic()
+    for i in range(repeat):
+        timers = [r.register_timer((lambda e: r.NEVER), start_time + 1000. + j)
+                  for j in range(timer_count)]
+        for t in timers:
+            r.update_timer(t, start_time + 2000.)
+        for t in timers:
+            r.unregister_timer(t)
+    return repeat * timer_count / (r.monotonic() - start_time)
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-t", "--timers", type="string", dest="timers",
+                    default="1,10,100,1000",
+                    help="comma separated list of timer counts to test")
+    opts.add_option("-d", "--duration", type="float", dest="duration",
+                    default=1., help="duration of each wakeup test")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    print "%8s %16s %16s" % ("timers", "wakeups/second", "registers/second")
+    for timer_count in [int(v) for v in options.timers.split(',')]:
+        wakeups = bench_wakeups(timer_count, options.duration)
+        registers = bench_register(timer_count, max(1, 10000 // timer_count))
+        print "%8d %16.0f %16.0f" % (timer_count, wakeups, registers)
+
+if __name__ == '__main__':
+    main()
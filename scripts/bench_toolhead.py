@@ -0,0 +1,97 @@
+#!/usr/bin/env python2
+# Benchmark the host toolhead move processing
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, math, time, logging, resource
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import klippy
+
+# Create a printer object (in file output mode) from a config file
+def setup_printer(config_file, dictionary):
+    start_args = {'config_file': config_file, 'start_reason': 'startup',
+                  'debuginput': 'benchmark', 'debugoutput': os.devnull,
+                  'dictionary': dictionary}
+    printer = klippy.Printer(None, None, start_args)
+    printer._read_config()
+    printer.send_event("klippy:mcu_identify")
+    printer.send_event("klippy:connect")
+    return printer
+
+# Generate a list of small extruding moves around a circle
+def gen_moves(count, segment_len, center, radius=50.):
+    e_per_mm = .033
+    moves = []
+    for i in range(count):
+        angle = (i + 1) * segment_len / radius
+        moves.append([center[0] + radius * math.cos(angle),
+                      center[1] + radius * math.sin(angle), 1.,
+                      (i + 1) * segment_len * e_per_mm])
+    return moves
+
+# Approximate memory used by a toolhead Move object
+def get_move_size(move):
+    size = sys.getsizeof(move)
+    if hasattr(move, '__dict__'):
+        size += sys.getsizeof(move.__dict__)
+    for name in ['start_pos', 'end_pos', 'axes_d', 'axes_r',
+                 'timing_callbacks']:
+        size += sys.getsizeof(getattr(move, name))
+    return size
+
+class ProcessMovesTimer:
+    def __init__(self, toolhead):
+        self.orig_process_moves = toolhead._process_moves
+        toolhead._process_moves = self.process_moves
+        self.move_count = 0
+        self.total_time = 0.
+        self.move_size = 0
+    def process_moves(self, moves):
+        self.move_size = get_move_size(moves[0])
+        start_time = time.time()
+        self.orig_process_moves(moves)
+        self.total_time += time.time() - start_time
+        self.move_count += len(moves)
+
+def main():
+    usage = "%prog [options] <config file> <mcu dictionary>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count", default=50000,
+                    help="number of moves to generate")
+    opts.add_option("-s", "--segment", type="float", dest="segment",
+                    default=.5, help="length of each move (in mm)")
+    opts.add_option("-f", "--speed", type="float", dest="speed",
+                    default=100., help="move speed (in mm/s)")
+    opts.add_option("-c", "--center", type="string", dest="center",
+                    default="100,100", help="x,y center of the moves")
+    opts.add_option("-t", "--threads", type="int", dest="threads",
+                    help="number of step generation threads")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.WARNING)
+    printer = setup_printer(args[0], args[1])
+    toolhead = printer.lookup_object('toolhead')
+    if options.threads is not None:
+        toolhead._setup_step_gen_threads(options.threads)
+    center = [float(v) for v in options.center.split(',')]
+    toolhead.set_position([center[0] + 50., center[1], 1., 0.],
+                          homing_axes=(0, 1, 2))
+    timer = ProcessMovesTimer(toolhead)
+    moves = gen_moves(options.count, options.segment, center)
+    start_time = time.time()
+    for pos in moves:
+        toolhead.move(pos, options.speed)
+    toolhead.wait_moves()
+    total_time = time.time() - start_time
+    print "moves: %d" % (timer.move_count,)
+    print "total: %.0f moves/second" % (len(moves) / total_time,)
+    print "_process_moves: %.0f moves/second (%.3f seconds)" % (
+        timer.move_count / timer.total_time, timer.total_time)
+    print "move size: %d bytes" % (timer.move_size,)
+    print "max rss: %d KiB" % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python2
+# Script to pre-parse g-code files for faster virtual_sdcard printing
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import gcode_compile
+
+def main():
+    usage = "%prog [options] <gcode file> [<gcode file> ...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-o", "--output", dest="output",
+                    help="compiled output file (only with a single input)")
+    options, args = opts.parse_args()
+    if len(args) < 1:
+        opts.error("Incorrect number of arguments")
+    if options.output is not None and len(args) != 1:
+        opts.error("Can only specify an output file with a single input")
+    for filename in args:
+        dest = gcode_compile.compile_file(filename, options.output)
+        sys.stdout.write("Compiled %s to %s (%d -> %d bytes)\n" % (
+            filename, dest, os.path.getsize(filename),
+            os.path.getsize(dest)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python2
+# Simple micro-controller stand-in for testing the host over a socket
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, socket, select, time, json, zlib, random, logging
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+
+REPORT_TIME = 5.
+
+class SimMCU:
+    def __init__(self, dictionary, options):
+        self.msgparser = msgproto.MessageParser()
+        self.msgparser.process_identify(dictionary, decompress=False)
+        self.identify_data = zlib.compress(dictionary)
+        self.mcu_freq = self.msgparser.get_constant_float('CLOCK_FREQ')
+        self.move_count = options.move_count
+        self.drop_rate = options.drop_rate
+        self.home_time = options.home_time
+        self.start_time = time.time()
+        self.sock = None
+        self.handlers = {
+            'identify': self.cmd_identify, 'get_uptime': self.cmd_get_uptime,
+            'get_clock': self.cmd_get_clock, 'get_config': self.cmd_get_config,
+            'finalize_config': self.cmd_finalize_config,
+            'reset': self.cmd_reset, 'config_reset': self.cmd_reset,
+            'emergency_stop': self.cmd_emergency_stop,
+            'query_analog_in': self.cmd_query_analog_in,
+            'endstop_home': self.cmd_endstop_home,
+            'endstop_query_state': self.cmd_endstop_query_state,
+            'set_next_step_dir': self.cmd_set_next_step_dir,
+            'queue_step': self.cmd_queue_step,
+            'stepper_get_position': self.cmd_stepper_get_position,
+        }
+        self.reset()
+    def reset(self):
+        self.is_config = self.is_shutdown = 0
+        self.config_crc = 0
+        self.analog_reports = {}
+        self.endstops = {}
+        self.stepper_dir = {}
+        self.stepper_pos = {}
+        self.reset_stats()
+    def reset_stats(self):
+        self.stats = {'blocks': 0, 'bytes_read': 0, 'bytes_write': 0,
+                      'naks': 0, 'dropped': 0, 'invalid': 0, 'messages': 0,
+                      'queue_step': 0, 'steps': 0}
+    def get_clock(self):
+        return int((time.time() - self.start_time) * self.mcu_freq)
+    # Message transmission
+    def send(self, msgname, **params):
+        cmd = self.msgparser.messages_by_name[msgname].encode_by_name(**params)
+        self.send_block(''.join(map(chr, cmd)))
+    def send_block(self, cmd=''):
+        data = self.msgparser.encode(self.next_seq, cmd)
+        self.stats['bytes_write'] += len(data)
+        try:
+            self.sock.sendall(data)
+        except socket.error as e:
+            logging.info("Error writing to socket: %s", e)
+    # Command handlers
+    def cmd_identify(self, params):
+        offset, count = params['offset'], params['count']
+        self.send('identify_response', offset=offset,
+                  data=self.identify_data[offset:offset+count])
+    def cmd_get_uptime(self, params):
+        clock = self.get_clock()
+        self.send('uptime', high=clock >> 32, clock=clock & 0xffffffff)
+    def cmd_get_clock(self, params):
+        self.send('clock', clock=self.get_clock() & 0xffffffff)
+    def cmd_get_config(self, params):
+        self.send('config', is_config=self.is_config, crc=self.config_crc,
+                  move_count=self.move_count, is_shutdown=self.is_shutdown)
+    def cmd_finalize_config(self, params):
+        self.is_config = 1
+        self.config_crc = params['crc']
+    def cmd_reset(self, params):
+        logging.info("Reset requested")
+        self.reset()
+    def cmd_emergency_stop(self, params):
+        self.is_shutdown = 1
+        self.send('shutdown', clock=self.get_clock() & 0xffffffff,
+                  static_string_id='Command request')
+    def cmd_query_analog_in(self, params):
+        if not params['rest_ticks']:
+            self.analog_reports.pop(params['oid'], None)
+            return
+        value = (params['min_value'] + params['max_value']) // 2
+        self.analog_reports[params['oid']] = [
+            params['clock'], params['rest_ticks'], value]
+    def cmd_endstop_home(self, params):
+        trigger_time = None
+        if params['sample_count']:
+            trigger_time = time.time() + self.home_time
+        self.endstops[params['oid']] = trigger_time
+    def cmd_endstop_query_state(self, params):
+        oid = params['oid']
+        trigger_time = self.endstops.get(oid)
+        homing = trigger_time is not None and time.time() < trigger_time
+        if not homing:
+            self.endstops[oid] = None
+        self.send('endstop_state', oid=oid, homing=int(homing), pin_value=0)
+    def cmd_set_next_step_dir(self, params):
+        self.stepper_dir[params['oid']] = params['dir']
+    def cmd_queue_step(self, params):
+        oid, count = params['oid'], params['count']
+        if not self.stepper_dir.get(oid):
+            count = -count
+        self.stepper_pos[oid] = self.stepper_pos.get(oid, 0) + count
+        self.stats['queue_step'] += 1
+        self.stats['steps'] += params['count']
+    def cmd_stepper_get_position(self, params):
+        oid = params['oid']
+        self.send('stepper_position', oid=oid, pos=self.stepper_pos.get(oid, 0))
+    # Periodic events
+    def report_analog(self):
+        clock = self.get_clock()
+        for oid, report in self.analog_reports.items():
+            next_clock, rest_ticks, value = report
+            if clock - next_clock < 0:
+                continue
+            while clock - next_clock >= 0:
+                next_clock += rest_ticks
+            report[0] = next_clock
+            self.send('analog_in_state', oid=oid,
+                      next_clock=next_clock & 0xffffffff, value=value)
+    # Message block handling
+    def process_block(self, block):
+        self.stats['blocks'] += 1
+        if random.random() < self.drop_rate:
+            # Simulate a lost message block
+            self.stats['dropped'] += 1
+            return
+        seq = block[msgproto.MESSAGE_POS_SEQ] & msgproto.MESSAGE_SEQ_MASK
+        if seq != self.next_seq:
+            self.stats['naks'] += 1
+            self.send_block()
+            return
+        self.next_seq = (seq + 1) & msgproto.MESSAGE_SEQ_MASK
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while pos < len(block) - msgproto.MESSAGE_TRAILER_SIZE:
+            mid = self.msgparser.messages_by_id.get(block[pos])
+            if mid is None:
+                logging.info("Unknown command id %d", block[pos])
+                break
+            params, pos = mid.parse(block, pos)
+            self.stats['messages'] += 1
+            hdl = self.handlers.get(mid.name)
+            if hdl is not None:
+                hdl(params)
+        self.send_block()
+    def process_data(self, data):
+        while 1:
+            l = self.msgparser.check_packet(data)
+            if l == 0:
+                return data
+            if l < 0:
+                # Discard bytes until next sync
+                self.stats['invalid'] += 1
+                pos = data.find(msgproto.MESSAGE_SYNC)
+                data = data[pos+1:] if pos >= 0 else ""
+                continue
+            self.process_block(bytearray(data[:l]))
+            data = data[l:]
+    def report_stats(self, duration):
+        stats = self.stats
+        logging.info("Stats: %s queue_step/s=%.0f steps/s=%.0f", " ".join(
+            ["%s=%d" % (k, v) for k, v in sorted(stats.items())]),
+                     stats['queue_step'] / duration, stats['steps'] / duration)
+        self.reset_stats()
+    def run(self, sock):
+        self.sock = sock
+        self.next_seq = 0
+        data = ""
+        last_report = time.time()
+        while 1:
+            res = select.select([sock], [], [], .010)
+            if res[0]:
+                newdata = sock.recv(4096)
+                if not newdata:
+                    break
+                self.stats['bytes_read'] += len(newdata)
+                data = self.process_data(data + newdata)
+            self.report_analog()
+            curtime = time.time()
+            if curtime > last_report + REPORT_TIME:
+                self.report_stats(curtime - last_report)
+                last_report = curtime
+        self.report_stats(max(.001, time.time() - last_report))
+
+def main():
+    usage = "%prog [options] <dictionary file> <tcp:host:port | unix:path>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-m", "--move-count", type="int", dest="move_count",
+                    default=500, help="move queue size to report")
+    opts.add_option("-r", "--drop-rate", type="float", dest="drop_rate",
+                    default=0., help="fraction of message blocks to drop")
+    opts.add_option("-t", "--home-time", type="float", dest="home_time",
+                    default=.500, help="time until an endstop triggers")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    dict_filename, port = args
+    logging.basicConfig(level=logging.INFO)
+    f = open(dict_filename, 'rb')
+    dictionary = f.read()
+    f.close()
+    # Validate dictionary
+    json.loads(dictionary)
+    if port.startswith('tcp:'):
+        host, portnum = port[4:].rsplit(':', 1)
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen_sock.bind((host, int(portnum)))
+    elif port.startswith('unix:'):
+        filename = port[5:]
+        if os.path.exists(filename):
+            os.unlink(filename)
+        listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listen_sock.bind(filename)
+    else:
+        opts.error("Port must start with 'tcp:' or 'unix:'")
+    listen_sock.listen(1)
+    sim = SimMCU(dictionary, options)
+    while 1:
+        logging.info("Waiting for host connection on %s", port)
+        sock, addr = listen_sock.accept()
+        if port.startswith('tcp:'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        logging.info("Host connected")
+        sim.run(sock)
+        sock.close()
+        logging.info("Host disconnected")
+
+if __name__ == '__main__':
+    main()
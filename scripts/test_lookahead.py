@@ -0,0 +1,150 @@
+#!/usr/bin/env python2
+# Compare the toolhead lookahead planner against a reference version
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, logging
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import klippy
+from toolhead import LOOKAHEAD_FLUSH_TIME, MAX_FREE_MOVES
+
+# G-Code commands that are passed to the printer (all others are ignored)
+MOVE_COMMANDS = ['G0', 'G1', 'G90', 'G91', 'G92', 'M82', 'M83']
+
+# Create a printer object (in file output mode) from a config file
+def setup_printer(config_file, dictionary):
+    start_args = {'config_file': config_file, 'start_reason': 'startup',
+                  'debuginput': 'lookahead', 'debugoutput': os.devnull,
+                  'dictionary': dictionary}
+    input_fd = os.open(os.devnull, os.O_RDONLY)
+    printer = klippy.Printer(input_fd, None, start_args)
+    printer._read_config()
+    printer.send_event("klippy:mcu_identify")
+    printer.send_event("klippy:connect")
+    printer.send_event("klippy:ready")
+    return printer
+
+# The original lookahead algorithm - the full queue is traversed on
+# every flush.
+def reference_flush(self, lazy=False):
+    self.junction_flush = LOOKAHEAD_FLUSH_TIME
+    update_flush_count = lazy
+    queue = self.queue
+    flush_count = len(queue)
+    delayed = []
+    next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
+    for i in range(flush_count-1, -1, -1):
+        move = queue[i]
+        reachable_start_v2 = next_end_v2 + move.delta_v2
+        start_v2 = min(move.max_start_v2, reachable_start_v2)
+        reachable_smoothed_v2 = next_smoothed_v2 + move.smooth_delta_v2
+        smoothed_v2 = min(move.max_smoothed_v2, reachable_smoothed_v2)
+        if smoothed_v2 < reachable_smoothed_v2:
+            if (smoothed_v2 + move.smooth_delta_v2 > next_smoothed_v2
+                or delayed):
+                if update_flush_count and peak_cruise_v2:
+                    flush_count = i
+                    update_flush_count = False
+                peak_cruise_v2 = min(move.max_cruise_v2, (
+                    smoothed_v2 + reachable_smoothed_v2) * .5)
+                if delayed:
+                    if not update_flush_count and i < flush_count:
+                        mc_v2 = peak_cruise_v2
+                        for m, ms_v2, me_v2 in reversed(delayed):
+                            mc_v2 = min(mc_v2, ms_v2)
+                            m.set_junction(min(ms_v2, mc_v2), mc_v2
+                                           , min(me_v2, mc_v2))
+                    del delayed[:]
+            if not update_flush_count and i < flush_count:
+                cruise_v2 = min((start_v2 + reachable_start_v2) * .5
+                                , move.max_cruise_v2, peak_cruise_v2)
+                move.set_junction(min(start_v2, cruise_v2), cruise_v2
+                                  , min(next_end_v2, cruise_v2))
+        else:
+            delayed.append((move, start_v2, next_end_v2))
+        next_end_v2 = start_v2
+        next_smoothed_v2 = smoothed_v2
+    if update_flush_count or not flush_count:
+        return
+    moves = queue[:flush_count]
+    self.toolhead._process_moves(moves)
+    del queue[:flush_count]
+    for move in moves:
+        if move.timing_callbacks:
+            del move.timing_callbacks[:]
+    if len(self.free_moves) < MAX_FREE_MOVES:
+        self.free_moves.extend(moves)
+
+# Record the junction speeds and timing of every processed move
+class MoveRecorder:
+    def __init__(self, toolhead, use_reference):
+        self.move_queue = move_queue = toolhead.move_queue
+        self.orig_process_moves = toolhead._process_moves
+        toolhead._process_moves = self.process_moves
+        if use_reference:
+            self.orig_flush = (lambda lazy=False:
+                               reference_flush(move_queue, lazy))
+        else:
+            self.orig_flush = move_queue.flush
+        move_queue.flush = self.flush
+        self.results = []
+        self.flush_time = 0.
+    def flush(self, lazy=False):
+        start_time = time.time()
+        self.orig_flush(lazy)
+        self.flush_time += time.time() - start_time
+    def process_moves(self, moves):
+        start_time = time.time()
+        self.results.append([(m.start_pos, m.end_pos, m.start_v, m.cruise_v,
+                              m.end_v, m.accel_t, m.cruise_t, m.decel_t)
+                             for m in moves])
+        self.orig_process_moves(moves)
+        # Only report the time spent in the lookahead calculations
+        self.flush_time -= time.time() - start_time
+
+def run_gcode(config_file, dictionary, lines, use_reference):
+    printer = setup_printer(config_file, dictionary)
+    toolhead = printer.lookup_object('toolhead')
+    toolhead.set_position([0., 0., 0., 0.], homing_axes=(0, 1, 2))
+    gcode = printer.lookup_object('gcode')
+    recorder = MoveRecorder(toolhead, use_reference)
+    gcode.run_script_from_command("\n".join(lines))
+    toolhead.wait_moves()
+    return recorder
+
+def main():
+    usage = "%prog [options] <config file> <mcu dictionary> <gcode file>"
+    opts = optparse.OptionParser(usage)
+    options, args = opts.parse_args()
+    if len(args) != 3:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.WARNING)
+    lines = []
+    f = open(args[2], 'rb')
+    for line in f:
+        parts = line.split(';', 1)[0].split()
+        if parts and parts[0].upper() in MOVE_COMMANDS:
+            lines.append(line.strip())
+    f.close()
+    ref = run_gcode(args[0], args[1], lines, True)
+    new = run_gcode(args[0], args[1], lines, False)
+    ref_moves = [m for batch in ref.results for m in batch]
+    new_moves = [m for batch in new.results for m in batch]
+    print "moves: %d (reference) %d (incremental)" % (
+        len(ref_moves), len(new_moves))
+    print "flushes: %d (reference) %d (incremental)" % (
+        len(ref.results), len(new.results))
+    print "lookahead time: %.3f (reference) %.3f (incremental)" % (
+        ref.flush_time, new.flush_time)
+    for i, (r, n) in enumerate(zip(ref_moves, new_moves)):
+        if r != n:
+            print "Move %d differs:\n  %s\n  %s" % (i, r, n)
+            sys.exit(1)
+    if ref.results != new.results:
+        print "Moves were flushed in different batches"
+        sys.exit(1)
+    print "Lookahead results are identical"
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+; generated by CaféSlicer_1.0
+;TIME:60
+G28
+G1 X20 Y20 Z1 F6000
+G1 X25 Y25
+G1 X20 Y20
@@ -0,0 +1,2 @@
+G28
+G1 X10 Y10 Z2 F6000